@@ -8,19 +8,38 @@ import string
 import asyncio
 import re
 import signal
+import socket
+import json
+import hashlib
+import csv
+import gzip
+import tempfile
+import contextvars
+import sys
+import time
+import traceback
+import tracemalloc
+from collections import Counter, deque
+from itertools import islice
+from contextlib import contextmanager
+from io import BytesIO, TextIOWrapper
 from datetime import datetime, timedelta, timezone
-from threading import Thread
+from threading import Thread, Lock, get_ident, current_thread, enumerate as enumerate_threads
 from urllib.parse import urlparse, parse_qs, quote_plus
 
 import pytz
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
 
 from pyrogram import Client, filters
-from pyrogram.errors import UserNotParticipant, UserIsBlocked, InputUserDeactivated, MessageNotModified, RPCError
-from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery
+from pyrogram.errors import UserNotParticipant, UserIsBlocked, InputUserDeactivated, MessageNotModified, RPCError, FloodWait, PeerIdInvalid
+from pyrogram.types import (InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery,
+                            InlineQuery, InlineQueryResultArticle, InputTextMessageContent)
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo.read_preferences import ReadPreference
+from pymongo.errors import DuplicateKeyError
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.mongodb import MongoDBJobStore
 from apscheduler.jobstores.base import JobLookupError
@@ -36,8 +55,13 @@ load_dotenv()
 API_ID = int(os.environ.get("API_ID", 0))
 API_HASH = os.environ.get("API_HASH", "")
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
+# extra bot tokens for the delivery pool (comma separated); each bot must be a member of the storage channels
+DELIVERY_BOT_TOKENS = [t.strip() for t in os.environ.get("DELIVERY_BOT_TOKENS", "").split(",") if t.strip()]
+DELIVERY_MAX_PER_SECOND = int(os.environ.get("DELIVERY_MAX_PER_SECOND", 25))  # per client, below Telegram's ~30 msg/s
 MONGO_URI = os.environ.get("MONGO_URI", "")
 LOG_CHANNEL = int(os.environ.get("LOG_CHANNEL", "0") or 0)
+# storage pool for new files: "chat_id[:weight],chat_id[:weight]", defaults to LOG_CHANNEL alone
+STORAGE_CHANNELS_STR = os.environ.get("STORAGE_CHANNELS", "")
 UPDATE_CHANNEL = os.environ.get("UPDATE_CHANNEL", "")  # public channel username (without @), leave empty to disable
 ADMIN_IDS_STR = os.environ.get("ADMIN_IDS", "")
 ADMINS = [int(x.strip()) for x in ADMIN_IDS_STR.split(",") if x.strip().isdigit()]
@@ -50,8 +74,57 @@ FREE_DELETE_DELAY_MINUTES = int(os.environ.get("FREE_DELETE_DELAY_MINUTES", 60))
 PAID_DELETE_DELAY_HOURS = int(os.environ.get("PAID_DELETE_DELAY_HOURS", 24))
 PAYMENT_EXPIRATION_MINUTES = int(os.environ.get("PAYMENT_EXPIRATION_MINUTES", 60))
 APPROVAL_EXPIRATION_HOURS = int(os.environ.get("APPROVAL_EXPIRATION_HOURS", 24))
+ENTITLEMENT_CACHE_SECONDS = int(os.environ.get("ENTITLEMENT_CACHE_SECONDS", 300))
 IST = pytz.timezone("Asia/Kolkata")
 
+# event-loop watchdog configs
+LOOP_MONITOR_ENABLED = os.environ.get("LOOP_MONITOR_ENABLED", "true").lower() in ("1", "true", "yes")
+LOOP_MONITOR_INTERVAL = float(os.environ.get("LOOP_MONITOR_INTERVAL", 0.5))  # seconds between heartbeats
+LOOP_BLOCK_THRESHOLD_MS = int(os.environ.get("LOOP_BLOCK_THRESHOLD_MS", 300))
+
+# on-demand profiler configs
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.01))  # seconds between stack samples
+PROFILE_MAX_SECONDS = int(os.environ.get("PROFILE_MAX_SECONDS", 120))
+
+# payment pipeline tracing configs
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 5000))  # spans kept in memory
+TRACE_EXPORT_FILE = os.environ.get("TRACE_EXPORT_FILE", "")  # optional JSONL file, leave empty to keep spans in memory only
+
+# graceful shutdown
+DRAIN_TIMEOUT_SECONDS = int(os.environ.get("DRAIN_TIMEOUT_SECONDS", 25))  # keep below the orchestrator's kill timeout
+HANDOFF_POLL_SECONDS = int(os.environ.get("HANDOFF_POLL_SECONDS", 10))  # rolling restarts: the old process drains after we start
+
+# analytics configs
+ANALYTICS_FLUSH_SECONDS = int(os.environ.get("ANALYTICS_FLUSH_SECONDS", 30))
+ANALYTICS_READ_PREFERENCE = os.environ.get("ANALYTICS_READ_PREFERENCE", "secondaryPreferred")  # /stats, /linkinfo, /toplinks, exports
+
+# broadcast configs
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 8))
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 20))  # messages per second across all workers
+BROADCAST_CHUNK_SIZE = int(os.environ.get("BROADCAST_CHUNK_SIZE", 200))  # users per checkpoint
+
+# owner payment digest configs
+DIGEST_WINDOW_SECONDS = int(os.environ.get("DIGEST_WINDOW_SECONDS", 60))
+DIGEST_MAX_ITEMS = int(os.environ.get("DIGEST_MAX_ITEMS", 25))  # flush early so text & keyboard stay within Telegram limits
+
+# admission control defaults (tokens per second / burst size); changeable at runtime with /limits
+DEFAULT_RATE_LIMITS = {
+    "upload": {"user_rate": 2.0, "user_burst": 30, "global_rate": 50.0, "global_burst": 200},
+    "start": {"user_rate": 0.5, "user_burst": 5, "global_rate": 30.0, "global_burst": 100},
+    "callback": {"user_rate": 2.0, "user_burst": 10, "global_rate": 50.0, "global_burst": 200},
+}
+MAX_SESSION_FILES = int(os.environ.get("MAX_SESSION_FILES", 500))
+
+# inline search configs
+INLINE_RESULTS_LIMIT = int(os.environ.get("INLINE_RESULTS_LIMIT", 20))
+INLINE_CACHE_SECONDS = int(os.environ.get("INLINE_CACHE_SECONDS", 30))
+
+# upload aggregation: the batch menu is refreshed once a burst of files goes quiet
+UPLOAD_QUIET_SECONDS = float(os.environ.get("UPLOAD_QUIET_SECONDS", 0.75))
+UPLOAD_ALBUM_QUIET_SECONDS = float(os.environ.get("UPLOAD_ALBUM_QUIET_SECONDS", 1.5))  # album parts trickle in
+UPLOAD_MAX_WAIT_SECONDS = float(os.environ.get("UPLOAD_MAX_WAIT_SECONDS", 5))  # still show progress on long forwards
+
 # -------------------------
 # Flask web app for webhook automation & health checks
 # -------------------------
@@ -83,51 +156,342 @@ def shortcut_webhook():
     if not payment_record:
         return jsonify({"status":"info","message":"No pending user for this amount."}), 200
 
-    batch_record = files_collection.find_one({"_id": payment_record.get("batch_id")})
-    if batch_record and batch_record.get("owner_id") in ADMINS:
-        payment_id = payment_record["_id"]
-        # schedule process_payment_approval to run in bot loop
-        future = asyncio.run_coroutine_threadsafe(process_payment_approval(payment_id, approved_by="Automation 🤖"), app.loop)
-        try:
-            future.result(timeout=20)
-            return jsonify({"status":"success","message":f"Admin payment {unique_amount} approved."}), 200
-        except Exception as e:
-            logging.error("Automation approval task error: %s", e)
-            return jsonify({"status":"error","message":f"Async task failed: {e}"}), 500
-    else:
-        return jsonify({"status":"info","message":"Payment is for a normal user, manual approval required."}), 200
+    with trace_span("shortcut_webhook", trace_id=payment_record["_id"], amount=unique_amount) as span:
+        batch_record = files_collection.find_one({"_id": payment_record.get("batch_id")}, BATCH_READ_PROJECTION)
+        span["auto_approve"] = bool(batch_record and batch_record.get("owner_id") in ADMINS)
+        if span["auto_approve"]:
+            payment_id = payment_record["_id"]
+            # schedule process_payment_approval to run in bot loop
+            future = asyncio.run_coroutine_threadsafe(process_payment_approval(payment_id, approved_by="Automation 🤖"), app.loop)
+            try:
+                future.result(timeout=20)
+                return jsonify({"status":"success","message":f"Admin payment {unique_amount} approved."}), 200
+            except Exception as e:
+                logging.error("Automation approval task error: %s", e)
+                span["error"] = str(e)
+                return jsonify({"status":"error","message":f"Async task failed: {e}"}), 500
+        else:
+            return jsonify({"status":"info","message":"Payment is for a normal user, manual approval required."}), 200
 
-def run_flask():
+@flask_app.route("/api/profile", methods=["POST"])
+def profile_webhook():
+    """Run the sampling profiler for ?seconds=N and return collapsed stacks + top allocations (secret required)."""
+    provided_secret = request.headers.get("X-Shortcut-Secret")
+    if not AUTOMATION_SECRET or provided_secret != AUTOMATION_SECRET:
+        return jsonify({"status":"error","message":"Unauthorized"}), 403
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        return jsonify({"status":"error","message":"Bad Request: seconds must be a number"}), 400
+    try:
+        collapsed, allocations = run_profile(seconds)
+    except RuntimeError as e:
+        return jsonify({"status":"error","message":str(e)}), 409
+    return jsonify({"status":"success","collapsed":collapsed,"allocations":allocations}), 200
+
+@flask_app.route("/ready", methods=["GET", "HEAD"])
+def ready_route():
+    # readiness: 200 only once every service in start_services() is up
+    if services_ready.is_set():
+        return "ready", 200
+    return "starting", 503
+
+def start_http_server():
+    """Bind the HTTP port (raises if taken) and serve Flask from a background thread."""
     # note: for production use a WSGI server instead of Flask built-in server
-    flask_app.run(host="0.0.0.0", port=PORT)
+    server = make_server("0.0.0.0", PORT, flask_app, threaded=True)
+    _resources["http"] = server
+    Thread(target=server.serve_forever, daemon=True, name="http").start()
 
 # -------------------------
-# MongoDB & APScheduler setup
+# MongoDB & APScheduler setup (lazy)
 # -------------------------
-try:
-    mongo_client = MongoClient(MONGO_URI)
-    db = mongo_client["file_link_bot"]
-    files_collection = db["file_batches"]
-    users_collection = db["users"]
-    settings_collection = db["settings"]
-    payments_collection = db["pending_payments"]
-    logging.info("Connected to MongoDB.")
-except Exception as e:
-    logging.exception("Failed to connect to MongoDB: %s", e)
-    raise SystemExit("MongoDB connection required.")
+# Nothing touches the network at import time: the MongoClient (and its SRV/DNS lookup)
+# is created on first use, collections are proxies that resolve on first attribute
+# access, and the scheduler gets its Mongo job store in init_scheduler().
+_resources = {}  # {"mongo": MongoClient, "http": werkzeug server}
+_resources_lock = Lock()
+
+def get_mongo_client() -> MongoClient:
+    client = _resources.get("mongo")
+    if client is None:
+        with _resources_lock:
+            client = _resources.get("mongo")
+            if client is None:
+                client = _resources["mongo"] = MongoClient(MONGO_URI)
+    return client
+
+def get_db():
+    return get_mongo_client()["file_link_bot"]
+
+class LazyCollection:
+    """Stand-in for a pymongo Collection that is resolved on first use."""
+    __slots__ = ("_name", "_collection")
+
+    def __init__(self, name: str):
+        self._name = name
+        self._collection = None
+
+    def __getattr__(self, attr):
+        collection = self._collection
+        if collection is None:
+            collection = self._collection = get_db()[self._name]
+        return getattr(collection, attr)
+
+files_collection = LazyCollection("file_batches")
+BATCH_READ_PROJECTION = {"file_names": 0}  # per-file search names are only read by inline search
+users_collection = LazyCollection("users")
+settings_collection = LazyCollection("settings")
+payments_collection = LazyCollection("pending_payments")
+stored_files_collection = LazyCollection("stored_files")  # {_id: store key (file_unique_id:caption hash), chat_id, log_msg_id, refs}
+digests_collection = LazyCollection("digests")  # sent payment digests with approvals still actionable
+handoff_collection = LazyCollection("handoff")  # unfinished work saved by drain() for the next process
+entitlements_collection = LazyCollection("entitlements")  # {buyer_id, batch_id, payment_id, amount, created_at}: paid batches a buyer owns
+batch_stats_collection = LazyCollection("batch_stats")  # {_id: "<batch_id>:<YYYY-MM-DD>", batch_id, day, clicks, deliveries, ...}
+
+scheduler = BackgroundScheduler(timezone="Asia/Kolkata")
 
-jobstores = {"default": MongoDBJobStore(database="file_link_bot", collection="scheduler_jobs", client=mongo_client)}
-scheduler = BackgroundScheduler(jobstores=jobstores, timezone="Asia/Kolkata")
+# -------------------------
+# Schema: declared indexes & read-preference routing
+# -------------------------
+# Every index the bot's queries rely on, per collection: (keys, options).
+# ensure_indexes() builds them idempotently (create_indexes is a no-op for existing ones).
+INDEXES = {
+    "pending_payments": [
+        ([("unique_amount", ASCENDING)], {}),  # shortcut_webhook, amount allocation
+    ],
+    "users": [
+        ([("banned", ASCENDING)], {}),  # /stats, broadcast & export filters
+    ],
+    "file_batches": [
+        ([("is_paid", ASCENDING)], {}),  # /stats, export
+        # /mylinks keyset pagination: newest-first per owner, _id breaks created_at ties
+        ([("owner_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)], {}),
+        # inline search: owner_id prefix keeps every text search inside one owner's batches
+        ([("owner_id", ASCENDING), ("file_names", TEXT)], {"name": "owner_file_names_text"}),
+    ],
+    "scheduler_jobs": [
+        ([("next_run_time", ASCENDING)], {"sparse": True}),  # same spec APScheduler's job store uses
+    ],
+    "digests": [
+        # approvals in a digest time out with the approval request itself
+        ([("created_at", ASCENDING)], {"expireAfterSeconds": APPROVAL_EXPIRATION_HOURS * 3600}),
+    ],
+    "handoff": [
+        ([("process_id", ASCENDING)], {}),  # handoff_poller claims other processes' docs
+    ],
+    "stored_files": [
+        ([("log_msg_id", ASCENDING), ("chat_id", ASCENDING)], {}),  # reference counting
+        ([("refs", ASCENDING), ("last_used_at", ASCENDING)], {}),  # prune_stored_files
+    ],
+    "entitlements": [
+        ([("buyer_id", ASCENDING), ("batch_id", ASCENDING)], {"unique": True}),  # re-delivery lookup in process_link_click
+    ],
+    "batch_stats": [
+        ([("batch_id", ASCENDING), ("day", ASCENDING)], {}),  # /linkinfo analytics
+        ([("day", ASCENDING)], {}),  # /toplinks
+    ],
+}
+
+# Representative queries that must be served by an index (see /indexcheck).
+QUERY_PLAN_CHECKS = [
+    ("pending_payments", {"unique_amount": "10.01"}, None),
+    ("users", {"banned": True}, None),
+    ("file_batches", {"is_paid": True}, None),
+    ("file_batches", {"owner_id": 0}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("file_batches", {"owner_id": 0, "$text": {"$search": "video"}}, None),
+    ("stored_files", {"log_msg_id": {"$in": [0]}, "chat_id": 0}, None),
+    ("stored_files", {"refs": {"$lte": 0}, "last_used_at": {"$lt": datetime(1970, 1, 1)}}, None),
+    ("entitlements", {"buyer_id": 0, "batch_id": ""}, None),
+    ("batch_stats", {"batch_id": ""}, None),
+    ("batch_stats", {"day": {"$gte": "1970-01-01"}}, None),
+    ("scheduler_jobs", {"next_run_time": {"$lte": 0}}, [("next_run_time", ASCENDING)]),
+]
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+_analytics_collections = {}
+
+def analytics_collection(name: str):
+    """Collection handle for analytical reads, using ANALYTICS_READ_PREFERENCE."""
+    collection = _analytics_collections.get(name)
+    if collection is None:
+        read_pref = READ_PREFERENCES.get(ANALYTICS_READ_PREFERENCE, ReadPreference.SECONDARY_PREFERRED)
+        collection = _analytics_collections[name] = get_db().get_collection(name, read_preference=read_pref)
+    return collection
+
+def ensure_indexes():
+    for name, specs in INDEXES.items():
+        try:
+            get_db()[name].create_indexes([IndexModel(keys, **options) for keys, options in specs])
+        except Exception as e:
+            logging.warning("Could not build indexes on %s: %s", name, e)
+    logging.info("Index check complete.")
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    for key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(key), dict):
+            yield from _plan_stages(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+def check_query_plans() -> list:
+    """[(collection, filter, winning stages, uses_collscan)] for QUERY_PLAN_CHECKS (blocking)."""
+    results = []
+    for name, query, sort in QUERY_PLAN_CHECKS:
+        cursor = get_db()[name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        winning = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        stages = [stage for stage in _plan_stages(winning) if stage]
+        results.append((name, query, stages, "COLLSCAN" in stages))
+    return results
 
 # -------------------------
 # Pyrogram bot client
 # -------------------------
 app = Client("filelinkbot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
-# in-memory session/state holders (non-persistent)
-user_sessions = {}   # {user_id: {'files': [Message,...], 'menu_msg_id': int, 'job': asyncio.Task|None}}
+# in-memory session/state holders (saved to `handoff` on graceful shutdown)
+user_sessions = {}   # {user_id: {'files': [(msg_id, store_key, file_name)], 'albums': set, 'menu_msg_id': int, 'last_msg_id': int, 'last_seen': float, 'job': asyncio.Task|None}}
 user_states = {}     # {user_id: {...}} for multi-step flows
-EDIT_SESSIONS = {}   # {batch_id: {'owner_id': id, 'files': [log_msg_ids], 'edit_msg_id': int}}
+inflight_deliveries = {}  # {delivery asyncio.Task: {'user_id', 'batch_id', 'delay_amount', 'delay_unit', 'next_index'}}
+runtime_state = {"draining": False}
+PROCESS_ID = f"{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}"  # tags the handoff docs this process writes
+services_ready = asyncio.Event()  # set once start_services() has brought everything up; handlers wait for it
+EDIT_SESSIONS = {}   # {batch_id: {'owner_id': id, 'original_files': [(chat_id, msg_id)], 'files': [(chat_id, msg_id)], 'file_names': {"chat_id:msg_id": name}, 'page': int, 'edit_msg_id': int}}
+
+# -------------------------
+# Delivery client pool (extra bot tokens)
+# -------------------------
+# Helper bots only copy stored files to buyers and delete them later; the main `app`
+# keeps every interactive update. A helper can only message users who have started
+# it, so any failure on a helper falls back to the main client for that file.
+delivery_clients = [
+    Client(f"delivery_{idx}", api_id=API_ID, api_hash=API_HASH, bot_token=token, no_updates=True)
+    for idx, token in enumerate(DELIVERY_BOT_TOKENS)
+]
+delivery_stats = {
+    c.name: {"healthy": False, "sent": 0, "failed": 0, "fallbacks": 0, "inflight": 0, "flood_until": 0.0, "recent": deque()}
+    for c in [app] + delivery_clients
+}
+
+# (helper name, user_id) -> expires_at: the helper could not reach that user (never started it,
+# blocked it), so it is skipped for them instead of paying a failed RPC per file
+DELIVERY_UNREACHABLE_TTL = 6 * 3600
+_helper_unreachable = {}
+
+def _helper_can_reach(name: str, user_id: int, now: float) -> bool:
+    expires_at = _helper_unreachable.get((name, user_id))
+    if expires_at is None:
+        return True
+    if expires_at <= now:
+        _helper_unreachable.pop((name, user_id), None)
+        return True
+    return False
+
+def _mark_helper_unreachable(name: str, user_id: int):
+    now = time.monotonic()
+    if len(_helper_unreachable) > 50000:
+        for key in [k for k, expires_at in _helper_unreachable.items() if expires_at <= now]:
+            _helper_unreachable.pop(key, None)
+    _helper_unreachable[(name, user_id)] = now + DELIVERY_UNREACHABLE_TTL
+
+def get_client_by_name(name: str = None) -> Client:
+    for c in delivery_clients:
+        if c.name == name:
+            return c
+    return app
+
+def _recent_sends(stats: dict, now: float) -> int:
+    recent = stats["recent"]
+    while recent and now - recent[0] > 1.0:
+        recent.popleft()
+    return len(recent)
+
+def pick_delivery_client(exclude=(), user_id: int = None) -> Client:
+    """Least-loaded healthy helper that can reach `user_id` and is not flood-limited or over its per-second budget, else the main client."""
+    now = time.monotonic()
+    best, best_key = None, None
+    for c in delivery_clients:
+        stats = delivery_stats[c.name]
+        if c.name in exclude or not stats["healthy"] or stats["flood_until"] > now:
+            continue
+        if user_id is not None and not _helper_can_reach(c.name, user_id, now):
+            continue
+        recent = _recent_sends(stats, now)
+        if recent >= DELIVERY_MAX_PER_SECOND:
+            continue
+        key = (stats["inflight"], recent)
+        if best_key is None or key < best_key:
+            best, best_key = c, key
+    return best or app
+
+async def delivery_copy_message(user_id: int, from_chat_id: int, message_id: int):
+    """Copy a stored file to `user_id` through the pool. Returns (client_used, sent_msg)."""
+    tried = set()
+    while True:
+        client = pick_delivery_client(exclude=tried, user_id=user_id)
+        stats = delivery_stats[client.name]
+        stats["inflight"] += 1
+        try:
+            sent_msg = await client.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+            stats["sent"] += 1
+            stats["recent"].append(time.monotonic())
+            return client, sent_msg
+        except FloodWait as e:
+            stats["flood_until"] = time.monotonic() + e.value
+            if client is app:
+                raise
+            logging.warning("Delivery client %s flood-limited for %ss", client.name, e.value)
+        except Exception as e:
+            stats["failed"] += 1
+            if client is app:
+                raise
+            if isinstance(e, (PeerIdInvalid, UserIsBlocked, InputUserDeactivated)):
+                # this helper can't reach the user, whatever the file; other errors (deleted source,
+                # helper missing from a storage channel) only fall back for this file
+                _mark_helper_unreachable(client.name, user_id)
+            logging.info("Delivery client %s could not deliver to %s (%s); falling back", client.name, user_id, e)
+        finally:
+            stats["inflight"] -= 1
+        stats["fallbacks"] += 1
+        tried.add(client.name)
+
+async def start_delivery_clients():
+    async def _start(c: Client):
+        try:
+            await c.start()
+            delivery_stats[c.name]["healthy"] = True
+            logging.info("Delivery client %s started.", c.name)
+        except Exception as e:
+            logging.warning("Delivery client %s failed to start: %s", c.name, e)
+    await asyncio.gather(*(_start(c) for c in delivery_clients))
+
+async def stop_delivery_clients():
+    for c in delivery_clients:
+        if delivery_stats[c.name]["healthy"]:
+            delivery_stats[c.name]["healthy"] = False
+            try:
+                await c.stop()
+            except Exception as e:
+                logging.warning("Error stopping delivery client %s: %s", c.name, e)
+
+def get_delivery_pool_text() -> str:
+    now = time.monotonic()
+    lines = []
+    for name, stats in delivery_stats.items():
+        state = "🟢" if stats["healthy"] or name == app.name else "🔴"
+        if stats["flood_until"] > now:
+            state = f"⏳{stats['flood_until'] - now:.0f}s"
+        lines.append(f"   - `{name}` {state} sent `{stats['sent']}` failed `{stats['failed']}` fallbacks `{stats['fallbacks']}` rate `{_recent_sends(stats, now)}/s`")
+    return "\n".join(lines)
 
 # -------------------------
 # Utility helpers
@@ -164,6 +528,7 @@ async def add_user_to_db(message: Message):
         "first_name": getattr(u, "first_name", None),
         "last_name": getattr(u, "last_name", None),
         "username": getattr(u, "username", None),
+        "unreachable": False,  # they are talking to us again, so broadcasts can reach them
     }
     try:
         users_collection.update_one({"_id": u.id}, {"$set": doc, "$setOnInsert": {"banned": False, "joined_date": datetime.now(timezone.utc)}}, upsert=True)
@@ -191,6 +556,9 @@ def get_help_text_and_keyboard(user_id: int):
         "__**Available Commands:**__\n"
         "__/start__ `- Restart the bot and clear any session.`\n"
         "__/editlink <batch_id>__ `- Edit an existing link you created.`\n"
+        "__/mylinks__ `- List the links you have created.`\n"
+        "__@bot <file name>__ `- Search your links from any chat and share them.`\n"
+        "__/digest on|off__ `- Group payment notifications into one message.`\n"
         "__/help__ `- Show this help message.`\n\n"
     )
     if user_id in ADMINS:
@@ -201,84 +569,827 @@ def get_help_text_and_keyboard(user_id: int):
             "__/stats__ - Bot stats.\n"
             "__/settings__ - Change bot mode.\n"
             "__/ban <user_id>__, /unban <user_id>__\n"
-            "__/linkinfo <batch_id>__ - Get details of a link.\n\n"
+            "__/linkinfo <batch_id>__ - Get details of a link.\n"
+            "__/loopstats__ - Event-loop lag and blocking call sites.\n"
+            "__/profile <seconds>__ - CPU & memory profile of the running bot.\n"
+            "__/trace <payment_id>__ - Timeline of a paid purchase.\n"
+            "__/migrateids__ - Compact old batches to range-encoded ids.\n"
+            "__/prunestore__ - Delete stored files no link uses anymore.\n"
+            "__/toplinks [days] [clicks|sales|revenue]__ - Hottest links.\n"
+            "__/broadcast__ - Reply to a message to send it to all users.\n"
+            "__/limits__ - View or change rate limits.\n"
+            "__/export <batches|users|payments>__ - Download data as CSV/JSONL.\n"
+            "__/indexcheck__ - Verify hot queries use indexes.\n\n"
         )
     return help_text, InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Start", callback_data="back_to_start")]])
 
+# -------------------------
+# Storage channel pool
+# -------------------------
+# Stored files are referenced as (chat_id, msg_id) pairs. New files are placed on the
+# STORAGE_CHANNELS pool by weighted round-robin; LOG_CHANNEL stays the implicit home
+# of everything stored before the pool existed.
+def parse_storage_channels(value: str) -> list:
+    channels = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        chat_id, _, weight = item.partition(":")
+        try:
+            channels.append((int(chat_id), max(1, int(weight or 1))))
+        except ValueError:
+            logging.warning("Ignoring invalid STORAGE_CHANNELS entry: %s", item)
+    return channels or [(LOG_CHANNEL, 1)]
+
+STORAGE_CHANNELS = parse_storage_channels(STORAGE_CHANNELS_STR)
+_storage_rotation = [chat_id for chat_id, weight in STORAGE_CHANNELS for _ in range(weight)]
+_storage_cursor = {"next": 0}
+
+def storage_channels_in_order() -> list:
+    """Storage channels to try for the next file: the round-robin pick first, then the rest as failover."""
+    idx = _storage_cursor["next"] % len(_storage_rotation)
+    _storage_cursor["next"] = idx + 1
+    first = _storage_rotation[idx]
+    return [first] + [chat_id for chat_id, _ in STORAGE_CHANNELS if chat_id != first]
+
+# -------------------------
+# Batch message_id storage (range-encoded)
+# -------------------------
+# v1 batch docs store "message_ids": [id, id, ...] (all in LOG_CHANNEL). v2+ docs store runs
+# of consecutive ids as "message_ranges": [[start, count], ...]; since v3 a run on another
+# storage channel carries it as a third element: [start, count, chat_id].
+# Readers go through the helpers below so every format keeps working.
+BATCH_IDS_VERSION = 3
+
+def encode_message_ranges(files) -> list:
+    """[(L, 5), (L, 6), (L, 7), (C, 10), (C, 11)] -> [[5, 3], [10, 2, C]] (order preserved, L = LOG_CHANNEL)."""
+    ranges = []
+    for chat_id, msg_id in files:
+        if ranges:
+            last = ranges[-1]
+            last_chat = last[2] if len(last) > 2 else LOG_CHANNEL
+            if last_chat == chat_id and last[0] + last[1] == msg_id:
+                last[1] += 1
+                continue
+        ranges.append([msg_id, 1] if chat_id == LOG_CHANNEL else [msg_id, 1, chat_id])
+    return ranges
+
+def encode_batch_message_ids(files) -> dict:
+    """Fields to store on a batch document for `files` [(chat_id, msg_id), ...] (use with insert or $set)."""
+    return {"message_ranges": encode_message_ranges(files), "message_ids_v": BATCH_IDS_VERSION}
+
+def iter_batch_files(batch_record: dict):
+    """Lazily yield (chat_id, msg_id) of every stored file of a batch, whatever its storage version."""
+    if "message_ranges" in batch_record:
+        for entry in batch_record["message_ranges"]:
+            start, count = entry[0], entry[1]
+            chat_id = entry[2] if len(entry) > 2 else LOG_CHANNEL
+            for msg_id in range(start, start + count):
+                yield chat_id, msg_id
+    else:
+        for msg_id in batch_record.get("message_ids", []):
+            yield LOG_CHANNEL, msg_id
+
+def get_batch_file_count(batch_record: dict) -> int:
+    if "message_ranges" in batch_record:
+        return sum(entry[1] for entry in batch_record["message_ranges"])
+    return len(batch_record.get("message_ids", []))
+
+def migrate_batch_message_ids(chunk_size: int = 500) -> int:
+    """
+    Online migration of v1 batch docs to range encoding (blocking; run in a thread).
+    Only touches docs still lacking message_ranges, so it is safe to run while the bot serves
+    traffic and to re-run after an interruption. Returns the number of migrated docs.
+    """
+    migrated = 0
+    ops = []
+    cursor = files_collection.find({"message_ranges": {"$exists": False}, "message_ids": {"$exists": True}},
+                                   {"message_ids": 1}, batch_size=chunk_size)
+    for doc in cursor:
+        ops.append(UpdateOne({"_id": doc["_id"], "message_ranges": {"$exists": False}},
+                             {"$set": encode_batch_message_ids((LOG_CHANNEL, i) for i in doc.get("message_ids", [])),
+                              "$unset": {"message_ids": ""}}))
+        if len(ops) >= chunk_size:
+            migrated += files_collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        migrated += files_collection.bulk_write(ops, ordered=False).modified_count
+    return migrated
+
 # -------------------------
 # Scheduler-backed asynchronous actions
 # -------------------------
-def delete_message_job(chat_id: int, message_ids: list):
-    """Schedule wrapper used by APScheduler: run in event loop to delete messages."""
+inflight_futures = set()  # coroutines handed to the bot loop from scheduler threads (awaited by drain)
+
+def submit_to_bot_loop(coro):
+    future = asyncio.run_coroutine_threadsafe(coro, app.loop)
+    inflight_futures.add(future)
+    future.add_done_callback(inflight_futures.discard)
+    return future
+
+def delete_message_job(chat_id: int, message_ids: list, client_name: str = None):
+    """Schedule wrapper used by APScheduler: run in event loop to delete messages (with the client that sent them)."""
     async def _task():
         try:
-            await app.delete_messages(chat_id=chat_id, message_ids=message_ids)
+            await get_client_by_name(client_name).delete_messages(chat_id=chat_id, message_ids=message_ids)
         except Exception as e:
             logging.warning("Failed to delete messages %s in %s: %s", message_ids, chat_id, e)
     if app.is_connected:
-        asyncio.run_coroutine_threadsafe(_task(), app.loop)
+        submit_to_bot_loop(_task())
 
 def expire_payment_job(payment_id: str, user_id: int, batch_id: str):
     async def _task():
-        if payments_collection.find_one_and_delete({"_id": payment_id}):
-            logging.info("Payment session %s expired for user %s.", payment_id, user_id)
-            try:
-                me = await app.get_me()
-                share_link = f"https://t.me/{me.username}?start={batch_id}"
-                await app.send_message(user_id, f"__⏳ Your payment session has expired. Please generate a new payment link: {share_link}__")
-            except Exception:
-                pass
+        with trace_span("expire_payment_job", trace_id=payment_id) as span:
+            span["expired"] = bool(payments_collection.find_one_and_delete({"_id": payment_id}))
+            if span["expired"]:
+                logging.info("Payment session %s expired for user %s.", payment_id, user_id)
+                try:
+                    me = await app.get_me()
+                    share_link = f"https://t.me/{me.username}?start={batch_id}"
+                    await app.send_message(user_id, f"__⏳ Your payment session has expired. Please generate a new payment link: {share_link}__")
+                except Exception:
+                    pass
     if app.is_connected:
-        asyncio.run_coroutine_threadsafe(_task(), app.loop)
+        submit_to_bot_loop(_task())
 
 def expire_approval_job(payment_id: str, user_id: int, owner_id: int):
     async def _task():
-        if payments_collection.find_one_and_delete({"_id": payment_id}):
-            logging.info("Approval request %s expired.", payment_id)
-            try:
-                await app.send_message(user_id, f"__😔 The seller did not respond to your payment confirmation. Request cancelled.__")
-                await app.send_message(owner_id, f"__⚠️ The approval request {payment_id} expired.__")
-            except Exception:
-                pass
+        with trace_span("expire_approval_job", trace_id=payment_id) as span:
+            span["expired"] = bool(payments_collection.find_one_and_delete({"_id": payment_id}))
+            if span["expired"]:
+                logging.info("Approval request %s expired.", payment_id)
+                try:
+                    await app.send_message(user_id, f"__😔 The seller did not respond to your payment confirmation. Request cancelled.__")
+                    await app.send_message(owner_id, f"__⚠️ The approval request {payment_id} expired.__")
+                except Exception:
+                    pass
     if app.is_connected:
-        asyncio.run_coroutine_threadsafe(_task(), app.loop)
+        submit_to_bot_loop(_task())
+
+# -------------------------
+# Event-loop lag monitor & blocking-call detector
+# -------------------------
+# The heartbeat coroutine runs on the bot loop and stamps `last_beat`; a plain
+# thread watches the stamp and, when the loop stops ticking for longer than
+# LOOP_BLOCK_THRESHOLD_MS, grabs the loop thread's stack to see what is blocking it.
+loop_monitor = {
+    "thread_id": None,       # ident of the thread running the event loop
+    "last_beat": 0.0,        # time.monotonic() of the last heartbeat
+    "lag_ms": 0.0,           # lag measured on the last heartbeat
+    "max_lag_ms": 0.0,
+    "stalls": 0,             # number of detected blocking episodes
+    "sites": Counter(),      # {"func (bot.py:123)": count}
+}
+
+def _blocking_site(stack: traceback.StackSummary) -> str:
+    """Return the innermost frame from this file (plus the library call it is stuck in)."""
+    this_file = os.path.abspath(__file__)
+    for idx in range(len(stack) - 1, -1, -1):
+        frame = stack[idx]
+        if os.path.abspath(frame.filename) == this_file:
+            site = f"{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})"
+            if idx + 1 < len(stack):
+                site += f" -> {stack[idx + 1].name}"
+            return site
+    if stack:
+        frame = stack[-1]
+        return f"{frame.name} ({os.path.basename(frame.filename)}:{frame.lineno})"
+    return "unknown"
+
+async def loop_heartbeat():
+    """Measure event-loop lag by comparing actual vs requested sleep time."""
+    loop_monitor["thread_id"] = get_ident()
+    while True:
+        started = time.monotonic()
+        loop_monitor["last_beat"] = started
+        await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+        lag_ms = max(0.0, (time.monotonic() - started - LOOP_MONITOR_INTERVAL) * 1000)
+        loop_monitor["lag_ms"] = lag_ms
+        loop_monitor["max_lag_ms"] = max(loop_monitor["max_lag_ms"], lag_ms)
+
+def loop_watchdog():
+    """Background thread: capture the loop's stack once per stall that exceeds the threshold."""
+    threshold = LOOP_BLOCK_THRESHOLD_MS / 1000.0
+    reported_beat = None
+    while True:
+        time.sleep(max(threshold / 2, 0.05))
+        beat = loop_monitor["last_beat"]
+        thread_id = loop_monitor["thread_id"]
+        if not beat or thread_id is None or beat == reported_beat:
+            continue
+        stalled = time.monotonic() - beat - LOOP_MONITOR_INTERVAL
+        if stalled < threshold:
+            continue
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            continue
+        stack = traceback.extract_stack(frame)
+        del frame
+        site = _blocking_site(stack)
+        reported_beat = beat
+        loop_monitor["stalls"] += 1
+        loop_monitor["sites"][site] += 1
+        logging.warning("Event loop blocked for %.0f ms at %s\n%s", stalled * 1000, site, "".join(traceback.format_list(stack[-12:])))
+
+def start_loop_monitor():
+    """Start heartbeat (on the running loop) and watchdog thread if enabled."""
+    if not LOOP_MONITOR_ENABLED:
+        return
+    asyncio.get_running_loop().create_task(loop_heartbeat())
+    Thread(target=loop_watchdog, daemon=True, name="loop-watchdog").start()
+    logging.info("Event-loop monitor started (threshold %d ms).", LOOP_BLOCK_THRESHOLD_MS)
+
+def get_loop_monitor_text(top: int = 10) -> str:
+    if not LOOP_MONITOR_ENABLED:
+        return "__Event-loop monitor is disabled (set `LOOP_MONITOR_ENABLED=true`).__"
+    text = (
+        f"__🩺 **Event Loop Monitor**\n\n- Current Lag: `{loop_monitor['lag_ms']:.1f} ms`\n"
+        f"- Max Lag: `{loop_monitor['max_lag_ms']:.1f} ms`\n- Blocking Episodes (>{LOOP_BLOCK_THRESHOLD_MS} ms): `{loop_monitor['stalls']}`__\n"
+    )
+    sites = loop_monitor["sites"].most_common(top)
+    if sites:
+        text += "\n__**Top Blocking Sites:**__\n" + "\n".join(f"`{count}×` `{site}`" for site, count in sites)
+    return text
 
 # -------------------------
-# File info fetcher (from LOG_CHANNEL)
+# On-demand sampling profiler (CPU stacks + tracemalloc)
 # -------------------------
-async def get_file_details(msg_id: int):
+_profile_lock = Lock()
+
+def _collapse_frame(frame) -> str:
+    """Build a flamegraph 'collapsed' stack (root first, frames joined by ';') for one thread."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name}@{os.path.basename(code.co_filename)}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+def run_profile(seconds: float):
+    """
+    Blocking: sample every thread's stack and trace allocations for `seconds`.
+    Returns (collapsed_stacks_text, allocation_report_text). Only one profile may run at a time.
+    """
+    seconds = max(1.0, min(float(seconds), PROFILE_MAX_SECONDS))
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError("A profile is already running.")
+    started_tracing = False
+    try:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            started_tracing = True
+        baseline = tracemalloc.take_snapshot()
+
+        me = get_ident()
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            thread_names = {t.ident: t.name for t in enumerate_threads()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stacks[f"{thread_names.get(thread_id, thread_id)};{_collapse_frame(frame)}"] += 1
+            frame = None  # drop frame references between samples
+            samples += 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        _profile_lock.release()
+
+    collapsed = "\n".join(f"{stack} {count}" for stack, count in stacks.most_common())
+    lines = [
+        f"Profile window: {seconds:.0f}s, {samples} samples",
+        f"Traced memory: current={current / 1024 / 1024:.2f} MB peak={peak / 1024 / 1024:.2f} MB",
+        f"In-memory state: user_sessions={len(user_sessions)} user_states={len(user_states)} EDIT_SESSIONS={len(EDIT_SESSIONS)}",
+        "",
+        "Top allocation sites (live):",
+    ]
+    lines += [str(stat) for stat in snapshot.statistics("lineno")[:25]]
+    lines += ["", "Top allocation growth during window:"]
+    lines += [str(stat) for stat in snapshot.compare_to(baseline, "lineno")[:25]]
+    return collapsed, "\n".join(lines)
+
+# -------------------------
+# Payment pipeline tracing (trace id == payment_id)
+# -------------------------
+# Spans are timed blocks tagged with the payment_id they belong to. Inside one asyncio
+# task the id is carried by a ContextVar; across thread/scheduler boundaries
+# (Flask webhook, APScheduler jobs) it is passed explicitly because those
+# entry points already receive the payment_id.
+current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+trace_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+_trace_file_lock = Lock()
+
+def record_span(span: dict):
+    trace_buffer.append(span)
+    if not TRACE_EXPORT_FILE:
+        return
+    try:
+        with _trace_file_lock, open(TRACE_EXPORT_FILE, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(span, default=str) + "\n")
+    except OSError as e:
+        logging.warning("Could not export span to %s: %s", TRACE_EXPORT_FILE, e)
+
+@contextmanager
+def trace_span(name: str, trace_id: str = None, **attrs):
+    """
+    Time the enclosed block as a span of `trace_id` (defaults to the current trace).
+    Yields the attrs dict so callers can attach results. No-op when there is no trace.
+    """
+    trace_id = trace_id or current_trace_id.get()
+    if not TRACING_ENABLED or not trace_id:
+        yield attrs
+        return
+    token = current_trace_id.set(trace_id)
+    started_at = time.time()
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield attrs
+    except BaseException as e:
+        status = type(e).__name__
+        raise
+    finally:
+        current_trace_id.reset(token)
+        record_span({
+            "trace_id": trace_id,
+            "name": name,
+            "start": started_at,
+            "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+            "thread": current_thread().name,
+            "status": status,
+            "attrs": attrs,
+        })
+
+def get_trace_spans(trace_id: str) -> list:
+    """Spans for `trace_id` from the ring buffer, falling back to the JSONL export file (blocking)."""
+    spans = [s for s in list(trace_buffer) if s["trace_id"] == trace_id]
+    if not spans and TRACE_EXPORT_FILE and os.path.exists(TRACE_EXPORT_FILE):
+        with _trace_file_lock, open(TRACE_EXPORT_FILE, encoding="utf-8") as fh:
+            for line in fh:
+                if trace_id in line:
+                    try:
+                        span = json.loads(line)
+                    except ValueError:
+                        continue
+                    if span.get("trace_id") == trace_id:
+                        spans.append(span)
+    return sorted(spans, key=lambda s: s["start"])
+
+def format_trace_timeline(trace_id: str, spans: list) -> str:
+    if not spans:
+        return f"__❌ No spans recorded for payment `{trace_id}`.__"
+    origin = spans[0]["start"]
+    total = max(s["start"] + s["duration_ms"] / 1000 for s in spans) - origin
+    lines = [f"__🧭 **Trace** `{trace_id}` — `{len(spans)}` spans over `{total:.2f}s`__\n"]
+    for span in spans:
+        attrs = " ".join(f"{k}={v}" for k, v in span.get("attrs", {}).items())
+        status = "" if span.get("status") == "ok" else f" ❗{span['status']}"
+        lines.append(f"`+{span['start'] - origin:8.2f}s` **{span['name']}** `{span['duration_ms']:.0f} ms` __[{span.get('thread')}]{status} {attrs}__")
+    return "\n".join(lines)
+
+# -------------------------
+# Per-batch analytics (buffered counters, flushed with bulk $inc upserts)
+# -------------------------
+# Hot paths only bump in-memory counters; a background task folds them into one
+# batch_stats document per (batch, IST day) every ANALYTICS_FLUSH_SECONDS.
+analytics_buffer = {}  # {(batch_id, day): Counter({"clicks": n, "revenue": x, ...})}
+
+def record_batch_event(batch_id: str, **increments):
+    day = datetime.now(IST).strftime("%Y-%m-%d")
+    analytics_buffer.setdefault((batch_id, day), Counter()).update(increments)
+
+def _write_analytics(pending: dict):
+    ops = [
+        UpdateOne({"_id": f"{batch_id}:{day}"},
+                  {"$inc": dict(counters), "$setOnInsert": {"batch_id": batch_id, "day": day}}, upsert=True)
+        for (batch_id, day), counters in pending.items()
+    ]
+    if ops:
+        batch_stats_collection.bulk_write(ops, ordered=False)
+
+async def flush_analytics():
+    global analytics_buffer
+    if not analytics_buffer:
+        return
+    pending, analytics_buffer = analytics_buffer, {}
     try:
-        msg = await app.get_messages(LOG_CHANNEL, msg_id)
-        if msg is None:
-            return "DELETED/UNAVAILABLE FILE", "N/A"
-        if getattr(msg, "document", None):
-            return msg.document.file_name or "Document", f"{(msg.document.file_size or 0) / 1024 / 1024:.2f} MB"
-        elif getattr(msg, "video", None):
-            return msg.video.file_name or "Video File", f"{(msg.video.file_size or 0) / 1024 / 1024:.2f} MB"
-        elif getattr(msg, "photo", None):
-            return "Photo File", f"{(msg.photo.file_size or 0) / 1024 / 1024:.2f} MB"
-        elif getattr(msg, "audio", None):
-            return msg.audio.file_name or "Audio File", f"{(msg.audio.file_size or 0) / 1024 / 1024:.2f} MB"
-        return "Unknown File", "N/A"
+        await asyncio.to_thread(_write_analytics, pending)
     except Exception as e:
-        logging.warning("Could not get details for msg_id %s: %s", msg_id, e)
+        logging.warning("Analytics flush failed, keeping %d counters for retry: %s", len(pending), e)
+        for key, counters in pending.items():
+            analytics_buffer.setdefault(key, Counter()).update(counters)
+
+async def analytics_flusher():
+    while True:
+        await asyncio.sleep(ANALYTICS_FLUSH_SECONDS)
+        await flush_analytics()
+
+def get_batch_analytics(batch_id: str, days: int = 7) -> dict:
+    """All-time and last-`days` totals for a batch (flushed data plus the unflushed buffer)."""
+    since = (datetime.now(IST) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    total, recent = Counter(), Counter()
+    for doc in analytics_collection("batch_stats").find({"batch_id": batch_id}, {"_id": 0, "batch_id": 0}):
+        day = doc.pop("day")
+        total.update(doc)
+        if day >= since:
+            recent.update(doc)
+    for (bid, day), counters in analytics_buffer.items():
+        if bid == batch_id:
+            total.update(counters)
+            if day >= since:
+                recent.update(counters)
+    return {"total": total, "recent": recent}
+
+def get_top_links(days: int = 7, limit: int = 10, sort_by: str = "clicks") -> list:
+    since = (datetime.now(IST) - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    pipeline = [
+        {"$match": {"day": {"$gte": since}}},
+        {"$group": {"_id": "$batch_id", "clicks": {"$sum": "$clicks"}, "deliveries": {"$sum": "$deliveries"},
+                    "failures": {"$sum": "$delivery_failures"}, "sales": {"$sum": "$sales"}, "revenue": {"$sum": "$revenue"}}},
+        {"$sort": {sort_by: -1}},
+        {"$limit": limit},
+    ]
+    return list(analytics_collection("batch_stats").aggregate(pipeline))
+
+def format_analytics_line(counters) -> str:
+    return (f"👆 `{counters.get('clicks', 0)}` clicks | 📦 `{counters.get('deliveries', 0)}` deliveries | "
+            f"⚠️ `{counters.get('delivery_failures', counters.get('failures', 0))}` failed | "
+            f"🛒 `{counters.get('sales', 0)}` sales | 💵 `₹{counters.get('revenue', 0):.2f}`")
+
+# -------------------------
+# File info fetcher (from storage channels)
+# -------------------------
+EDIT_PAGE_SIZE = int(os.environ.get("EDIT_PAGE_SIZE", 10))
+
+def describe_file_message(msg):
+    if msg is None or getattr(msg, "empty", False):
         return "DELETED/UNAVAILABLE FILE", "N/A"
+    if getattr(msg, "document", None):
+        return msg.document.file_name or "Document", f"{(msg.document.file_size or 0) / 1024 / 1024:.2f} MB"
+    elif getattr(msg, "video", None):
+        return msg.video.file_name or "Video File", f"{(msg.video.file_size or 0) / 1024 / 1024:.2f} MB"
+    elif getattr(msg, "photo", None):
+        return "Photo File", f"{(msg.photo.file_size or 0) / 1024 / 1024:.2f} MB"
+    elif getattr(msg, "audio", None):
+        return msg.audio.file_name or "Audio File", f"{(msg.audio.file_size or 0) / 1024 / 1024:.2f} MB"
+    return "Unknown File", "N/A"
+
+async def get_files_details(file_refs: list) -> dict:
+    """{(chat_id, msg_id): (name, size)} for `file_refs`, one get_messages call per storage channel."""
+    by_chat = {}
+    for chat_id, msg_id in file_refs:
+        by_chat.setdefault(chat_id, []).append(msg_id)
+    details = {}
+    for chat_id, msg_ids in by_chat.items():
+        try:
+            msgs = await app.get_messages(chat_id, msg_ids)
+        except Exception as e:
+            logging.warning("Could not get details for %s messages in %s: %s", len(msg_ids), chat_id, e)
+            msgs = [None] * len(msg_ids)
+        for msg_id, msg in zip(msg_ids, msgs):
+            details[(chat_id, msg_id)] = describe_file_message(msg)
+    return details
 
 async def generate_edit_menu(batch_id: str):
-    batch_files = EDIT_SESSIONS.get(batch_id, {}).get("files", [])
+    """Render only the current page of the edit session; delete buttons carry the stable (chat_id, msg_id) key."""
+    session = EDIT_SESSIONS.get(batch_id, {})
+    batch_files = session.get("files", [])
+    pages = max(1, -(-len(batch_files) // EDIT_PAGE_SIZE))
+    page = min(max(session.get("page", 0), 0), pages - 1)
+    session["page"] = page
+    page_files = batch_files[page * EDIT_PAGE_SIZE:(page + 1) * EDIT_PAGE_SIZE]
+
     text = f"__✍️ **Editing Link:** `{batch_id}`__\n\n__You have **{len(batch_files)}** files in this batch. You can delete files or add more.__"
+    if pages > 1:
+        text += f"\n\n__📄 Page **{page + 1}/{pages}**__"
     buttons = []
-    for idx, log_msg_id in enumerate(batch_files):
-        fname, fsize = await get_file_details(log_msg_id)
-        buttons.append([InlineKeyboardButton(f"❌ {fname} ({fsize})", callback_data=f"edit_delete_{batch_id}_{idx}")])
+    details = await get_files_details(page_files)
+    for chat_id, msg_id in page_files:
+        fname, fsize = details[(chat_id, msg_id)]
+        buttons.append([InlineKeyboardButton(f"❌ {fname} ({fsize})", callback_data=f"edit_delete_{batch_id}_{chat_id}_{msg_id}")])
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"edit_page_{batch_id}_{page - 1}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("Next ➡️", callback_data=f"edit_page_{batch_id}_{page + 1}"))
+        buttons.append(nav)
     buttons.append([InlineKeyboardButton("➕ Add More Files", callback_data=f"edit_add_{batch_id}"),
                     InlineKeyboardButton("✅ Save Changes", callback_data=f"edit_save_{batch_id}")])
     buttons.append([InlineKeyboardButton("❌ Cancel Edit", callback_data=f"edit_cancel_{batch_id}")])
     return text, InlineKeyboardMarkup(buttons)
 
+# -------------------------
+# Content-addressed file store (dedup by file_unique_id + caption)
+# -------------------------
+# Every file copied into a storage channel is indexed by its store key: Telegram's
+# file_unique_id plus a hash of the caption (the _id, hence unique). Re-uploads of the same
+# file with the same caption reuse the stored copy instead of copying again; the caption is
+# part of the key because buyers receive the stored copy's caption, not the uploader's.
+# `refs` counts the saved batches that contain the stored message; a stored message may
+# only be pruned once it drops to zero and `last_used_at` (stamped on every copy or reuse)
+# is older than the grace period. Docs without chat_id live in LOG_CHANNEL.
+STORE_PRUNE_GRACE_HOURS = int(os.environ.get("STORE_PRUNE_GRACE_HOURS", 24))
+
+def get_file_unique_id(message: Message):
+    for kind in ("document", "video", "audio", "photo"):
+        media = getattr(message, kind, None)
+        if media is not None:
+            return getattr(media, "file_unique_id", None)
+    return None
+
+def get_file_store_key(message: Message):
+    file_unique_id = get_file_unique_id(message)
+    if not file_unique_id:
+        return None
+    caption = getattr(message, "caption", None) or ""
+    # html keeps the caption's entities (text links), which would leak just like the text
+    caption_hash = hashlib.sha1(getattr(caption, "html", caption).encode("utf-8")).hexdigest()[:16]
+    return f"{file_unique_id}:{caption_hash}"
+
+def get_file_name(message: Message):
+    """File name used for inline search: the media's file name, else the first line of the caption."""
+    for kind in ("document", "video", "audio"):
+        media = getattr(message, kind, None)
+        if media is not None and getattr(media, "file_name", None):
+            return media.file_name
+    caption = (getattr(message, "caption", None) or "").strip()
+    return caption.splitlines()[0][:100] if caption else None
+
+def _stored_file_ref(doc: dict) -> tuple:
+    return doc.get("chat_id") or LOG_CHANNEL, doc["log_msg_id"]
+
+async def copy_to_storage(from_chat_id: int, message_id: int):
+    """Copy a message onto the storage pool (round-robin, failing over to the other channels)."""
+    last_error = None
+    for chat_id in storage_channels_in_order():
+        try:
+            return await app.copy_message(chat_id, from_chat_id, message_id)
+        except Exception as e:
+            last_error = e
+            logging.warning("Storage channel %s rejected copy: %s", chat_id, e)
+    raise last_error
+
+async def store_file_in_log(from_chat_id: int, message_id: int, store_key: str = None) -> tuple:
+    """Return (chat_id, msg_id) of the stored copy of this file, copying it only if not stored yet."""
+    if store_key:
+        # stamp the reuse: until the batch being built is saved (and bumps refs) the doc may still
+        # have refs 0, and prune_stored_files only spares docs used within the grace period
+        stored = stored_files_collection.find_one_and_update(
+            {"_id": store_key}, {"$set": {"last_used_at": datetime.now(timezone.utc)}},
+            projection={"log_msg_id": 1, "chat_id": 1})
+        if stored:
+            return _stored_file_ref(stored)
+
+    copied = await copy_to_storage(from_chat_id, message_id)
+    if not store_key:
+        return copied.chat.id, copied.id
+    try:
+        stored_files_collection.insert_one({
+            "_id": store_key,
+            "chat_id": copied.chat.id,
+            "log_msg_id": copied.id,
+            "refs": 0,
+            "created_at": datetime.now(timezone.utc),
+            "last_used_at": datetime.now(timezone.utc)
+        })
+        return copied.chat.id, copied.id
+    except DuplicateKeyError:
+        # a concurrent upload of the same file won the race; keep theirs, drop our copy
+        stored = stored_files_collection.find_one_and_update(
+            {"_id": store_key}, {"$set": {"last_used_at": datetime.now(timezone.utc)}},
+            projection={"log_msg_id": 1, "chat_id": 1})
+        try:
+            await app.delete_messages(copied.chat.id, copied.id)
+        except Exception:
+            pass
+        return _stored_file_ref(stored)
+
+def update_file_refs(added=(), removed=()):
+    """Adjust stored-file reference counts when batches gain or lose (chat_id, msg_id) files."""
+    added, removed = set(added), set(removed)
+    added, removed = added - removed, removed - added
+    try:
+        for file_refs, delta in ((added, 1), (removed, -1)):
+            by_chat = {}
+            for chat_id, msg_id in file_refs:
+                by_chat.setdefault(chat_id, []).append(msg_id)
+            for chat_id, msg_ids in by_chat.items():
+                chat_filter = {"$in": [chat_id, None]} if chat_id == LOG_CHANNEL else chat_id
+                stored_files_collection.update_many({"log_msg_id": {"$in": msg_ids}, "chat_id": chat_filter}, {"$inc": {"refs": delta}})
+    except Exception as e:
+        logging.warning("Failed to update stored file refs: %s", e)
+
+async def prune_stored_files() -> int:
+    """Delete stored messages no saved batch refers to and nobody used within the grace period."""
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=STORE_PRUNE_GRACE_HOURS)
+    pruned = 0
+    while True:
+        # find_one_and_delete re-checks both atomically: a save bumps refs, and a batch still being
+        # built has stamped last_used_at when it reused the file
+        doc = stored_files_collection.find_one_and_delete({"refs": {"$lte": 0}, "last_used_at": {"$lt": cutoff}})
+        if not doc:
+            break
+        chat_id, msg_id = _stored_file_ref(doc)
+        try:
+            await app.delete_messages(chat_id, msg_id)
+        except Exception as e:
+            logging.warning("Failed to prune stored message %s in %s: %s", msg_id, chat_id, e)
+        pruned += 1
+    return pruned
+
+# -------------------------
+# Admission control (per-user & global token buckets)
+# -------------------------
+# Group -1 handlers run before everything else and drop over-limit updates with
+# stop_propagation(), so a flooding user never reaches the real handlers. Admins
+# are exempt. Limits live in settings ("rate_limits") and can be changed with /limits.
+RATE_LIMITS = {kind: dict(values) for kind, values in DEFAULT_RATE_LIMITS.items()}
+RATE_LIMITS_SETTING_ID = "rate_limits"
+_user_buckets = {}    # {(kind, user_id): [tokens, updated]}
+_global_buckets = {}  # {kind: [tokens, updated]}
+_last_reject_notice = {}  # {user_id: monotonic time}
+join_waiters = {}  # {user_id: {"task": asyncio.Task, "batch_id": str, "checks": int, "started": epoch}}
+
+def _take_token(buckets: dict, key, rate: float, burst: float, now: float) -> bool:
+    bucket = buckets.get(key)
+    if bucket is None:
+        bucket = buckets[key] = [float(burst), now]
+    bucket[0] = min(float(burst), bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if bucket[0] >= 1.0:
+        bucket[0] -= 1.0
+        return True
+    return False
+
+def _prune_user_buckets(now: float):
+    """Forget buckets that have refilled completely; they behave exactly like new ones."""
+    for key in [k for k, (tokens, updated) in _user_buckets.items()
+                if tokens + (now - updated) * RATE_LIMITS[k[0]]["user_rate"] >= RATE_LIMITS[k[0]]["user_burst"]]:
+        del _user_buckets[key]
+
+def admit(user_id: int, kind: str) -> bool:
+    """Take one token from the user's and the global bucket for `kind`."""
+    if user_id in ADMINS or kind not in RATE_LIMITS:
+        return True
+    limits = RATE_LIMITS[kind]
+    now = time.monotonic()
+    if len(_user_buckets) > 50000:
+        _prune_user_buckets(now)
+    if not _take_token(_user_buckets, (kind, user_id), limits["user_rate"], limits["user_burst"], now):
+        return False
+    if not _take_token(_global_buckets, kind, limits["global_rate"], limits["global_burst"], now):
+        _user_buckets[(kind, user_id)][0] += 1.0  # refund; the user isn't the one over the limit
+        return False
+    return True
+
+REJECT_NOTICE_INTERVAL = 10  # seconds between "slow down" replies to the same user
+
+def _prune_reject_notices(now: float):
+    """Forget notices older than the interval; they no longer suppress anything."""
+    for user_id in [u for u, at in _last_reject_notice.items() if now - at >= REJECT_NOTICE_INTERVAL]:
+        del _last_reject_notice[user_id]
+
+def should_notify_rejection(user_id: int) -> bool:
+    now = time.monotonic()
+    if len(_last_reject_notice) > 50000:
+        _prune_reject_notices(now)
+    if now - _last_reject_notice.get(user_id, 0) < REJECT_NOTICE_INTERVAL:
+        return False
+    _last_reject_notice[user_id] = now
+    return True
+
+def load_rate_limits():
+    doc = settings_collection.find_one({"_id": RATE_LIMITS_SETTING_ID}) or {}
+    for kind, values in doc.get("limits", {}).items():
+        if kind in RATE_LIMITS:
+            RATE_LIMITS[kind].update({k: float(v) for k, v in values.items() if k in RATE_LIMITS[kind]})
+
+def _classify_message(message: Message):
+    # filters.command hasn't run yet at group -1, so look at the raw text
+    text = (message.text or "").split(maxsplit=1)
+    if text and text[0].lower().split("@")[0] == "/start":
+        return "start"
+    if message.document or message.video or message.photo or message.audio:
+        return "upload"
+    return None
+
+@app.on_message(filters.private, group=-1)
+async def admission_gate_messages(client: Client, message: Message):
+    if not services_ready.is_set():
+        await services_ready.wait()
+    user_id = getattr(message.from_user, "id", None)
+    if runtime_state["draining"]:
+        if user_id and should_notify_rejection(user_id):
+            try:
+                await message.reply("__♻️ The bot is restarting. Please try again in a few seconds.__")
+            except Exception:
+                pass
+        message.stop_propagation()
+    kind = _classify_message(message)
+    if not user_id or not kind or admit(user_id, kind):
+        return
+    if should_notify_rejection(user_id):
+        try:
+            await message.reply("__🚦 You're sending too fast. Please wait a few seconds and try again.__")
+        except Exception:
+            pass
+    message.stop_propagation()
+
+@app.on_callback_query(group=-1)
+async def admission_gate_callbacks(client: Client, query: CallbackQuery):
+    if not services_ready.is_set():
+        await services_ready.wait()
+    if runtime_state["draining"]:
+        try:
+            await query.answer("♻️ The bot is restarting. Please try again in a few seconds.", show_alert=True)
+        except Exception:
+            pass
+        query.stop_propagation()
+    if admit(query.from_user.id, "callback"):
+        return
+    try:
+        await query.answer("🚦 Too many requests. Please slow down.", show_alert=False)
+    except Exception:
+        pass
+    query.stop_propagation()
+
+@app.on_message(filters.command("limits") & filters.private & filters.user(ADMINS))
+async def limits_handler(client: Client, message: Message):
+    args = message.command[1:]
+    if len(args) == 3:
+        kind, field, value = args[0].lower(), args[1].lower(), args[2]
+        if kind not in RATE_LIMITS or field not in RATE_LIMITS[kind]:
+            await message.reply("__❌ Unknown limit. Kinds: `upload`, `start`, `callback`; fields: `user_rate`, `user_burst`, `global_rate`, `global_burst`.__")
+            return
+        try:
+            RATE_LIMITS[kind][field] = max(0.01, float(value))
+        except ValueError:
+            await message.reply("__❌ Value must be a number.__")
+            return
+        settings_collection.update_one({"_id": RATE_LIMITS_SETTING_ID}, {"$set": {f"limits.{kind}.{field}": RATE_LIMITS[kind][field]}}, upsert=True)
+    elif args:
+        await message.reply("__Usage: `/limits` or `/limits <kind> <field> <value>`__")
+        return
+    lines = ["__🚦 **Admission Limits** (tokens/s, burst)__\n"]
+    for kind, values in RATE_LIMITS.items():
+        lines.append(f"**{kind}** — user `{values['user_rate']}/s`, `{values['user_burst']:.0f}` | global `{values['global_rate']}/s`, `{values['global_burst']:.0f}`")
+    lines.append(f"\n__Max files per upload session: `{MAX_SESSION_FILES}`__")
+    await message.reply("\n".join(lines))
+
 # -------------------------
 # Message handlers
 # -------------------------
+# background auto-check task: check periodically for membership and send files immediately once they join
+async def auto_check_and_send(client: Client, user_id: int, batch_id: str, checks: int = 12, interval: int = 5):
+    # total wait = checks * interval (by default 60s)
+    try:
+        for _ in range(checks):
+            await asyncio.sleep(interval)
+            if await is_user_member(client, user_id):
+                try:
+                    await client.send_message(user_id, "__✅ Thank you for joining! Preparing your files...__")
+                except Exception:
+                    pass
+                try:
+                    await process_link_click(client, user_id, batch_id)
+                except Exception as e:
+                    logging.exception("auto_check_and_send: failed to process_link_click: %s", e)
+                return
+        # after checks expired; remind user to join
+        try:
+            await client.send_message(user_id, "__⏳ You didn't join the channel yet. Please join to access files, then send /start again or open the link.__")
+        except Exception:
+            pass
+    except asyncio.CancelledError:
+        logging.debug("auto_check_and_send cancelled for user %s", user_id)
+    except Exception as e:
+        logging.exception("auto_check_and_send unexpected error: %s", e)
+
+def start_join_waiter(client: Client, user_id: int, batch_id: str, checks: int = 12):
+    """One poller per user: a repeated /start replaces the previous one."""
+    old_waiter = join_waiters.pop(user_id, None)
+    if old_waiter and not old_waiter["task"].done():
+        old_waiter["task"].cancel()
+
+    def _forget_waiter(task: asyncio.Task):
+        if join_waiters.get(user_id, {}).get("task") is task:
+            join_waiters.pop(user_id, None)
+    try:
+        task = asyncio.create_task(auto_check_and_send(client, user_id, batch_id, checks=checks))
+    except Exception as e:
+        logging.warning("Could not create auto_check task: %s", e)
+        return
+    join_waiters[user_id] = {"task": task, "batch_id": batch_id, "checks": checks, "started": time.time()}
+    task.add_done_callback(_forget_waiter)
+
 @app.on_message(filters.command("start") & filters.private)
 async def start_handler(client: Client, message: Message):
     await add_user_to_db(message)
@@ -312,40 +1423,8 @@ async def start_handler(client: Client, message: Message):
                 except Exception:
                     pass
 
-            # background auto-check task: check periodically for membership and send files immediately once they join
-            async def auto_check_and_send():
-                checks = 12  # number of checks
-                interval = 5  # seconds between checks -> total wait = checks * interval (here 60s)
-                try:
-                    for _ in range(checks):
-                        await asyncio.sleep(interval)
-                        if await is_user_member(client, user_id):
-                            try:
-                                await client.send_message(user_id, "__✅ Thank you for joining! Preparing your files...__")
-                            except Exception:
-                                pass
-                            try:
-                                await process_link_click(client, user_id, batch_id)
-                            except Exception as e:
-                                logging.exception("auto_check_and_send: failed to process_link_click: %s", e)
-                            return
-                    # after checks expired; remind user to join
-                    try:
-                        await client.send_message(user_id, "__⏳ You didn't join the channel yet. Please join to access files, then send /start again or open the link.__")
-                    except Exception:
-                        pass
-                except asyncio.CancelledError:
-                    logging.debug("auto_check_and_send cancelled for user %s", user_id)
-                except Exception as e:
-                    logging.exception("auto_check_and_send unexpected error: %s", e)
-
-            try:
-                asyncio.create_task(auto_check_and_send())
-            except Exception:
-                try:
-                    app.loop.create_task(auto_check_and_send())
-                except Exception as e:
-                    logging.warning("Could not create auto_check task: %s", e)
+            # background auto-check task: sends files as soon as they join
+            start_join_waiter(client, user_id, batch_id)
             return
 
         # user is already a member — send files directly
@@ -384,13 +1463,80 @@ async def close_message_callback(client: Client, query: CallbackQuery):
 
 @app.on_message(filters.command("stats") & filters.private & filters.user(ADMINS))
 async def stats_handler(client: Client, message: Message):
-    total_users = users_collection.count_documents({})
-    banned_users = users_collection.count_documents({"banned": True})
-    total_batches = files_collection.count_documents({})
-    paid_batches = files_collection.count_documents({"is_paid": True})
-    await message.reply(
-        f"__📊 **Bot Statistics**\n\n👤 **Users:**\n   - Total Users: `{total_users}`\n   - Banned Users: `{banned_users}`\n\n🔗 **Links (Batches):**\n   - Total Batches: `{total_batches}`\n   - Paid Batches: `{paid_batches}`\n   - Free Batches: `{total_batches - paid_batches}`__"
-    )
+    users_read, batches_read = analytics_collection("users"), analytics_collection("file_batches")
+    total_users = users_read.estimated_document_count()
+    banned_users = users_read.count_documents({"banned": True})
+    total_batches = batches_read.estimated_document_count()
+    paid_batches = batches_read.count_documents({"is_paid": True})
+    text = f"__📊 **Bot Statistics**\n\n👤 **Users:**\n   - Total Users: `{total_users}`\n   - Banned Users: `{banned_users}`\n\n🔗 **Links (Batches):**\n   - Total Batches: `{total_batches}`\n   - Paid Batches: `{paid_batches}`\n   - Free Batches: `{total_batches - paid_batches}`__"
+    if delivery_clients:
+        text += f"\n\n__🚚 **Delivery Pool:**__\n{get_delivery_pool_text()}"
+    await message.reply(text)
+
+@app.on_message(filters.command("loopstats") & filters.private & filters.user(ADMINS))
+async def loopstats_handler(client: Client, message: Message):
+    await message.reply(get_loop_monitor_text())
+
+@app.on_message(filters.command("profile") & filters.private & filters.user(ADMINS))
+async def profile_handler(client: Client, message: Message):
+    try:
+        seconds = float(message.command[1]) if len(message.command) > 1 else 10
+    except ValueError:
+        await message.reply("__Usage: `/profile <seconds>`__")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    status_msg = await message.reply(f"__⏳ Profiling for `{seconds:.0f}` seconds...__")
+    try:
+        collapsed, allocations = await asyncio.to_thread(run_profile, seconds)
+    except RuntimeError as e:
+        await status_msg.edit_text(f"__❌ {e}__")
+        return
+    stamp = datetime.now(IST).strftime("%Y%m%d-%H%M%S")
+    await client.send_document(message.chat.id, BytesIO(collapsed.encode("utf-8")), file_name=f"profile-{stamp}.collapsed.txt",
+                               caption="__🔥 CPU samples (collapsed stacks, use with flamegraph.pl / speedscope).__")
+    await client.send_document(message.chat.id, BytesIO(allocations.encode("utf-8")), file_name=f"profile-{stamp}.alloc.txt",
+                               caption="__🧠 Top allocation sites (tracemalloc).__")
+    try:
+        await status_msg.delete()
+    except Exception:
+        pass
+
+@app.on_message(filters.command("trace") & filters.private & filters.user(ADMINS))
+async def trace_handler(client: Client, message: Message):
+    if len(message.command) < 2:
+        await message.reply("__Usage: `/trace <payment_id>`__")
+        return
+    payment_id = message.command[1]
+    spans = await asyncio.to_thread(get_trace_spans, payment_id)
+    await message.reply(format_trace_timeline(payment_id, spans))
+
+@app.on_message(filters.command("migrateids") & filters.private & filters.user(ADMINS))
+async def migrate_ids_handler(client: Client, message: Message):
+    status_msg = await message.reply("__⏳ Migrating batch documents to range-encoded message ids...__")
+    try:
+        migrated = await asyncio.to_thread(migrate_batch_message_ids)
+    except Exception as e:
+        logging.exception("message_ids migration failed: %s", e)
+        await status_msg.edit_text(f"__❌ Migration failed: `{e}`. It is safe to run it again.__")
+        return
+    await status_msg.edit_text(f"__✅ Migrated **{migrated}** batch document(s).__")
+
+@app.on_message(filters.command("prunestore") & filters.private & filters.user(ADMINS))
+async def prune_store_handler(client: Client, message: Message):
+    pruned = await prune_stored_files()
+    await message.reply(f"__🧹 Pruned **{pruned}** unreferenced stored file(s).__")
+
+@app.on_message(filters.command("indexcheck") & filters.private & filters.user(ADMINS))
+async def indexcheck_handler(client: Client, message: Message):
+    try:
+        results = await asyncio.to_thread(check_query_plans)
+    except Exception as e:
+        await message.reply(f"__❌ Could not explain queries: `{e}`__")
+        return
+    lines = ["__🔎 **Query Plan Check**__\n"]
+    for name, query, stages, collscan in results:
+        lines.append(f"{'❌' if collscan else '✅'} `{name}` `{json.dumps(query, default=str)}` → `{' > '.join(stages)}`")
+    await message.reply("\n".join(lines))
 
 @app.on_message(filters.command("ban") & filters.private & filters.user(ADMINS))
 async def ban_handler(client: Client, message: Message):
@@ -425,24 +1571,44 @@ async def linkinfo_handler(client: Client, message: Message):
         await message.reply("__Usage: `/linkinfo <batch_id>`__")
         return
     batch_id = message.command[1]
-    batch = files_collection.find_one({"_id": batch_id})
+    batch = analytics_collection("file_batches").find_one({"_id": batch_id}, BATCH_READ_PROJECTION)
     if not batch:
         await message.reply(f"__❌ No link found with Batch ID: `{batch_id}`__")
         return
     owner_id = batch.get("owner_id")
-    owner_info = users_collection.find_one({"_id": owner_id}) or {}
+    owner_info = analytics_collection("users").find_one({"_id": owner_id}) or {}
     owner_details = f"__{owner_info.get('first_name','')} (@{owner_info.get('username','N/A')})__" if owner_info else "__Unknown (Not in DB)__"
     link_type = "Paid 💰" if batch.get("is_paid") else "Free 🆓"
-    file_count = len(batch.get("message_ids", []))
+    file_count = get_batch_file_count(batch)
     text = (
         f"__**🔗 Link Information**\n\n- **Batch ID:** `{batch_id}`\n"
         f"- **Link Type:** {link_type}\n- **File Count:** `{file_count}`\n\n"
         f"👤 **Owner Details:**\n- **User ID:** `{owner_id}`\n- **Name/Username:** {owner_details}__\n"
     )
     if batch.get("is_paid"):
-        text += f"__- **Price:** `₹{batch.get('price', 0):.2f}`\n- **UPI ID:** `{batch.get('upi_id', 'N/A')}`__"
+        text += f"__- **Price:** `₹{batch.get('price', 0):.2f}`\n- **UPI ID:** `{batch.get('upi_id', 'N/A')}`__\n"
+    stats = get_batch_analytics(batch_id)
+    text += f"\n__📈 **Analytics (7 days):**__\n{format_analytics_line(stats['recent'])}\n__📈 **Analytics (all time):**__\n{format_analytics_line(stats['total'])}"
     await message.reply(text)
 
+@app.on_message(filters.command("toplinks") & filters.private & filters.user(ADMINS))
+async def toplinks_handler(client: Client, message: Message):
+    days, sort_by = 7, "clicks"
+    for arg in message.command[1:]:
+        if arg.isdigit():
+            days = max(1, int(arg))
+        elif arg in ("clicks", "deliveries", "sales", "revenue"):
+            sort_by = arg
+    await flush_analytics()
+    rows = get_top_links(days=days, sort_by=sort_by)
+    if not rows:
+        await message.reply(f"__📉 No link activity in the last {days} day(s).__")
+        return
+    lines = [f"__🏆 **Top Links by {sort_by} (last {days} days)**__\n"]
+    for rank, row in enumerate(rows, 1):
+        lines.append(f"**{rank}.** `{row['_id']}`\n{format_analytics_line(row)}")
+    await message.reply("\n".join(lines))
+
 @app.on_message(filters.command("settings") & filters.private & filters.user(ADMINS))
 async def settings_handler(client: Client, message: Message):
     current_mode = await get_bot_mode()
@@ -503,25 +1669,52 @@ async def file_handler(client: Client, message: Message):
         # user is in a different flow (e.g. pricing, editing), don't accept new batch
         return
 
-    # create session
-    sess = user_sessions.setdefault(user_id, {"files": [], "menu_msg_id": None, "job": None})
-    sess["files"].append(message)
-
-    # debounce update to reduce spam
-    if sess.get("job") and not sess["job"].done():
-        sess["job"].cancel()
-
-    async def _update_batch_menu_job():
-        await asyncio.sleep(0.75)
-        await update_batch_menu(client, user_id, message)
-
-    sess["job"] = asyncio.create_task(_update_batch_menu_job())
-
-async def update_batch_menu(client: Client, user_id: int, last_message: Message):
-    if user_id not in user_sessions:
+    # create session; only ids are kept, the files are copied by id when the link is made
+    sess = user_sessions.setdefault(user_id, new_upload_session())
+    if len(sess["files"]) >= MAX_SESSION_FILES and user_id not in ADMINS:
+        if should_notify_rejection(user_id):
+            await message.reply(f"__❗️ A batch can hold at most **{MAX_SESSION_FILES}** files. Create the link, then start a new batch.__")
+        return
+    sess["files"].append((message.id, get_file_store_key(message), get_file_name(message)))
+    if message.media_group_id:
+        sess["albums"].add(str(message.media_group_id))
+    sess["last_msg_id"] = message.id
+    sess["last_seen"] = time.monotonic()
+    sess["in_album"] = bool(message.media_group_id)
+
+    # one aggregator task per session; new files just push its deadline back
+    if not sess.get("job") or sess["job"].done():
+        sess["job"] = asyncio.create_task(aggregate_uploads(client, user_id, sess))
+
+def new_upload_session() -> dict:
+    return {"files": [], "albums": set(), "menu_msg_id": None, "last_msg_id": None,
+            "last_seen": time.monotonic(), "in_album": False, "job": None}
+
+async def aggregate_uploads(client: Client, user_id: int, sess: dict):
+    """Wait until the current burst of uploads goes quiet (or UPLOAD_MAX_WAIT_SECONDS passes), then refresh the menu once."""
+    started = time.monotonic()
+    while True:
+        quiet = UPLOAD_ALBUM_QUIET_SECONDS if sess["in_album"] else UPLOAD_QUIET_SECONDS
+        now = time.monotonic()
+        wait = min(sess["last_seen"] + quiet, started + UPLOAD_MAX_WAIT_SECONDS) - now
+        if wait <= 0:
+            break
+        await asyncio.sleep(wait)
+    if user_sessions.get(user_id) is not sess:
+        return  # the batch was finished or reset meanwhile
+    shown = len(sess["files"])
+    await update_batch_menu(client, user_id)
+    if len(sess["files"]) > shown and user_sessions.get(user_id) is sess:
+        # files arrived while the menu was being updated; aggregate the rest of the burst
+        sess["job"] = asyncio.create_task(aggregate_uploads(client, user_id, sess))
+
+async def update_batch_menu(client: Client, user_id: int):
+    sess = user_sessions.get(user_id)
+    if not sess:
         return
-    file_count = len(user_sessions[user_id]["files"])
-    text = f"__✅ **Batch Updated!** You Have **{file_count}** Files In The Queue. What's Next?__"
+    file_count = len(sess["files"])
+    albums = f" ({len(sess['albums'])} album(s))" if sess["albums"] else ""
+    text = f"__✅ **Batch Updated!** You Have **{file_count}** Files{albums} In The Queue. What's Next?__"
     buttons = [
         [InlineKeyboardButton("🔗 Get Free Link", callback_data="get_link")],
         [InlineKeyboardButton("➕ Add More Files", callback_data="add_more")],
@@ -532,15 +1725,18 @@ async def update_batch_menu(client: Client, user_id: int, last_message: Message)
         buttons[0].append(InlineKeyboardButton("💰 Set Price & Sell", callback_data="set_price"))
 
     keyboard = InlineKeyboardMarkup(buttons)
-    old_menu_id = user_sessions[user_id].get("menu_msg_id")
-    if old_menu_id:
+    if sess.get("menu_msg_id"):
+        # edit the existing menu in place: one API call per refresh and no chat spam
         try:
-            await client.delete_messages(user_id, old_menu_id)
-        except Exception:
-            pass
+            await client.edit_message_text(user_id, sess["menu_msg_id"], text, reply_markup=keyboard)
+            return
+        except MessageNotModified:
+            return
+        except Exception as e:
+            logging.warning("Could not edit batch menu for %s, sending a new one: %s", user_id, e)
 
-    new_menu_msg = await last_message.reply_text(text, reply_markup=keyboard, quote=True)
-    user_sessions[user_id]["menu_msg_id"] = new_menu_msg.id
+    new_menu_msg = await client.send_message(user_id, text, reply_markup=keyboard, reply_to_message_id=sess.get("last_msg_id"))
+    sess["menu_msg_id"] = new_menu_msg.id
 
 @app.on_callback_query(filters.regex("^(get_link|add_more|set_price)$"))
 async def batch_options_callback(client: Client, query: CallbackQuery):
@@ -557,18 +1753,19 @@ async def batch_options_callback(client: Client, query: CallbackQuery):
         await query.answer("__✅ OK. Send Me More Files To Add To This Batch. ✅__", show_alert=True)
         return
 
-    # proceed to copy files to LOG_CHANNEL
+    # proceed to copy files to the storage channels
     try:
         await query.message.edit_text("__⏳ `Step 1/2`: Copying Files To Secure Storage...__")
     except MessageNotModified:
         pass
 
-    log_message_ids = []
+    stored_refs = []
+    # parallel to stored_refs ("" for unnamed files), so /editlink can tell which name belongs to which file
+    file_names = [name or "" for _, _, name in user_sessions[user_id]["files"]]
     try:
-        for msg in user_sessions[user_id]["files"]:
-            # copy each message to LOG_CHANNEL to store the file
-            copied = await msg.copy(chat_id=LOG_CHANNEL)
-            log_message_ids.append(copied.id)
+        for msg_id, store_key, _ in user_sessions[user_id]["files"]:
+            # store each file in a storage channel (reusing an existing copy when possible)
+            stored_refs.append(await store_file_in_log(user_id, msg_id, store_key))
     except Exception as e:
         logging.exception("Error copying files to log channel: %s", e)
         await query.message.edit_text(f"__❌ Error Copying Files: `{e}`. Please Start Again.__")
@@ -577,19 +1774,21 @@ async def batch_options_callback(client: Client, query: CallbackQuery):
 
     # generate batch_id and share link
     batch_id = generate_random_string(12)
-    bot_me = await app.get_me()
-    share_link = f"https://krpicture0.blogspot.com?start={batch_id}"
+    share_link = get_share_link(batch_id)
 
     if query.data == "get_link":
         # free link
         try:
             files_collection.insert_one({
                 "_id": batch_id,
-                "message_ids": log_message_ids,
+                **encode_batch_message_ids(stored_refs),
+                "file_names": file_names,
                 "owner_id": user_id,
                 "is_paid": False,
                 "created_at": datetime.now(timezone.utc)
             })
+            update_file_refs(added=stored_refs)
+            _inline_cache.pop(user_id, None)
         except Exception as e:
             logging.exception("DB insert failed: %s", e)
             await query.message.edit_text("__❌ Database error. Try again later.__")
@@ -597,7 +1796,7 @@ async def batch_options_callback(client: Client, query: CallbackQuery):
             return
 
         try:
-            await query.message.edit_text(f"__✅ **Free Link Generated for {len(log_message_ids)} file(s)!**\n\n`{share_link}`__", disable_web_page_preview=True)
+            await query.message.edit_text(f"__✅ **Free Link Generated for {len(stored_refs)} file(s)!**\n\n`{share_link}`__", disable_web_page_preview=True)
         except MessageNotModified:
             pass
         user_sessions.pop(user_id, None)
@@ -611,13 +1810,14 @@ async def batch_options_callback(client: Client, query: CallbackQuery):
             status_msg = await query.message.reply_text("__💰 **Set A Price For File!**\n\n__Please Send The Price For This Batch In INR **(e.g., `10`)**.__")
         user_states[user_id] = {
             "state": "waiting_for_price",
-            "log_ids": log_message_ids,
+            "file_refs": stored_refs,
+            "file_names": file_names,
             "batch_id": batch_id,
             "status_msgs": [status_msg.id]
         }
 
 # conversation handler for price, upi etc.
-@app.on_message(filters.private & filters.text & ~filters.command(["start","help","setupi","myupi","stats","settings","ban","unban","linkinfo","editlink"]), group=1)
+@app.on_message(filters.private & filters.text & ~filters.command(["start","help","setupi","myupi","stats","settings","ban","unban","linkinfo","editlink","loopstats","profile","trace","migrateids","prunestore","mylinks","toplinks","broadcast","digest","limits","export","indexcheck"]), group=1)
 async def conversation_handler(client: Client, message: Message):
     user_id = message.from_user.id
     if user_id not in user_states:
@@ -679,7 +1879,8 @@ async def create_paid_batch_in_db(client: Client, message: Message, state_info:
         batch_id = state_info["batch_id"]
         files_collection.insert_one({
             "_id": batch_id,
-            "message_ids": state_info["log_ids"],
+            **encode_batch_message_ids(state_info["file_refs"]),
+            "file_names": state_info.get("file_names", []),
             "owner_id": user_id,
             "is_paid": True,
             "price": float(state_info["price"]),
@@ -687,8 +1888,10 @@ async def create_paid_batch_in_db(client: Client, message: Message, state_info:
             "payee_name": message.from_user.first_name,
             "created_at": datetime.now(timezone.utc)
         })
-        share_link = f"https://krpicture0.blogspot.com?start={batch_id}"
-        await message.reply(f"__✅ **Paid Link Generated For {len(state_info['log_ids'])} file(s)!**\n\nPrice: `₹{state_info['price']:.2f}`\n\n`{share_link}`__", disable_web_page_preview=True)
+        update_file_refs(added=state_info["file_refs"])
+        _inline_cache.pop(user_id, None)
+        share_link = get_share_link(batch_id)
+        await message.reply(f"__✅ **Paid Link Generated For {len(state_info['file_refs'])} file(s)!**\n\nPrice: `₹{state_info['price']:.2f}`\n\n`{share_link}`__", disable_web_page_preview=True)
         # delete status messages
         try:
             await client.delete_messages(user_id, state_info.get("status_msgs", []))
@@ -732,11 +1935,21 @@ async def edit_link_command(client: Client, message: Message):
         await message.reply("__🔒 You can only edit links that you have created.__")
         return
 
-    EDIT_SESSIONS[batch_id] = {
+    original_files = list(iter_batch_files(batch_record))
+    session = EDIT_SESSIONS[batch_id] = {
         "owner_id": user_id,
-        "files": list(batch_record.get("message_ids", [])),
+        "original_files": original_files,
+        "files": list(original_files),
+        "file_names": {},
+        "page": 0,
         "edit_msg_id": None
     }
+    old_names = batch_record.get("file_names") or []
+    if len(old_names) == len(original_files):
+        session["file_names"] = {f"{chat_id}:{msg_id}": name for (chat_id, msg_id), name in zip(original_files, old_names)}
+    else:
+        # names not stored per file: keep them as they are and only add the new files' names
+        session["legacy_names"] = old_names
     user_states[user_id] = {"state": "editing_link", "batch_id": batch_id}
     text, keyboard = await generate_edit_menu(batch_id)
     edit_msg = await message.reply(text, reply_markup=keyboard)
@@ -746,7 +1959,7 @@ async def edit_link_command(client: Client, message: Message):
 async def edit_link_callbacks(client: Client, query: CallbackQuery):
     user_id = query.from_user.id
     parts = query.data.split("_")
-    # expected: edit_<action>_<batch_id>[_<index>]
+    # expected: edit_<action>_<batch_id>[_<chat_id>_<msg_id> | _<page>]
     if len(parts) < 3:
         await query.answer("Invalid action.", show_alert=True)
         return
@@ -760,13 +1973,29 @@ async def edit_link_callbacks(client: Client, query: CallbackQuery):
 
     if action == "delete":
         try:
-            index = int(parts[3])
-            del session["files"][index]
-            await query.answer("✅ File removed.")
-            text, keyboard = await generate_edit_menu(batch_id)
-            await query.message.edit_text(text, reply_markup=keyboard)
-        except Exception:
+            session["files"].remove((int(parts[3]), int(parts[4])))
+        except (IndexError, ValueError):
             await query.answer("Could not delete this file. It may have been removed.", show_alert=True)
+            return
+        await query.answer("✅ File removed.")
+        text, keyboard = await generate_edit_menu(batch_id)
+        try:
+            await query.message.edit_text(text, reply_markup=keyboard)
+        except MessageNotModified:
+            pass
+
+    elif action == "page":
+        try:
+            session["page"] = int(parts[3])
+        except (IndexError, ValueError):
+            await query.answer("Invalid page.", show_alert=True)
+            return
+        text, keyboard = await generate_edit_menu(batch_id)
+        try:
+            await query.message.edit_text(text, reply_markup=keyboard)
+        except MessageNotModified:
+            pass
+        await query.answer()
 
     elif action == "add":
         await query.answer("✅ OK. Send me more files to add to this batch. When done, click 'Save Changes'.", show_alert=True)
@@ -782,7 +2011,15 @@ async def edit_link_callbacks(client: Client, query: CallbackQuery):
         if not new_list:
             await query.answer("❗️ You cannot save an empty link. Add at least one file.", show_alert=True)
             return
-        files_collection.update_one({"_id": batch_id}, {"$set": {"message_ids": new_list}})
+        names = session.get("file_names", {})
+        if "legacy_names" in session:
+            original = set(session.get("original_files", []))
+            file_names = session["legacy_names"] + [names.get(f"{c}:{m}", "") for c, m in new_list if (c, m) not in original]
+        else:
+            file_names = [names.get(f"{c}:{m}", "") for c, m in new_list]
+        files_collection.update_one({"_id": batch_id}, {"$set": {**encode_batch_message_ids(new_list), "file_names": file_names}, "$unset": {"message_ids": ""}})
+        update_file_refs(added=new_list, removed=session.get("original_files", []))
+        _inline_cache.pop(session.get("owner_id"), None)
         del EDIT_SESSIONS[batch_id]
         user_states.pop(user_id, None)
         await query.message.edit_text(f"__✅ **Link `{batch_id}` updated successfully!** It now contains **{len(new_list)}** files.__")
@@ -800,8 +2037,11 @@ async def file_handler_for_editing(client: Client, message: Message):
         user_states.pop(user_id, None)
         return
     try:
-        copied = await message.copy(chat_id=LOG_CHANNEL)
-        EDIT_SESSIONS[batch_id]["files"].append(copied.id)
+        file_ref = await store_file_in_log(message.chat.id, message.id, get_file_store_key(message))
+        EDIT_SESSIONS[batch_id]["files"].append(file_ref)
+        EDIT_SESSIONS[batch_id].setdefault("file_names", {})[f"{file_ref[0]}:{file_ref[1]}"] = get_file_name(message) or ""
+        # show the page holding the newly added file
+        EDIT_SESSIONS[batch_id]["page"] = (len(EDIT_SESSIONS[batch_id]["files"]) - 1) // EDIT_PAGE_SIZE
         edit_msg_id = EDIT_SESSIONS[batch_id]["edit_msg_id"]
         text, keyboard = await generate_edit_menu(batch_id)
         # update the edit message in user's chat
@@ -814,64 +2054,247 @@ async def file_handler_for_editing(client: Client, message: Message):
         logging.exception("Could not add file to edit session: %s", e)
         await message.reply_text(f"__❌ Could not add file: {e}__")
 
+# -------------------------
+# Owner dashboard (/mylinks) with keyset pagination
+# -------------------------
+MYLINKS_PAGE_SIZE = int(os.environ.get("MYLINKS_PAGE_SIZE", 10))
+
+def get_owner_links_page(owner_id: int, after: tuple = None):
+    """
+    Newest-first page of an owner's batches, resuming strictly after `after` = (created_at, batch_id).
+    Uses the (owner_id, created_at, _id) index, so the cost doesn't grow with how deep the page is.
+    Returns (docs, next_cursor_or_None).
+    """
+    query = {"owner_id": owner_id}
+    if after:
+        created_at, batch_id = after
+        query["$or"] = [{"created_at": {"$lt": created_at}}, {"created_at": created_at, "_id": {"$lt": batch_id}}]
+    projection = {"created_at": 1, "is_paid": 1, "price": 1, "sales_count": 1, "message_ranges": 1, "message_ids": 1}
+    docs = list(files_collection.find(query, projection).sort([("created_at", -1), ("_id", -1)]).limit(MYLINKS_PAGE_SIZE + 1))
+    next_cursor = None
+    if len(docs) > MYLINKS_PAGE_SIZE:
+        docs = docs[:MYLINKS_PAGE_SIZE]
+        next_cursor = (docs[-1]["created_at"], docs[-1]["_id"])
+    return docs, next_cursor
+
+def render_owner_links_page(owner_id: int, after: tuple = None):
+    docs, next_cursor = get_owner_links_page(owner_id, after)
+    if not docs:
+        return "__🗂 You have not created any links yet. Send me a file to get started!__", None
+    lines = ["__🗂 **Your Links** (newest first)__\n"]
+    for doc in docs:
+        created = doc["created_at"].replace(tzinfo=timezone.utc).astimezone(IST).strftime("%d %b %Y") if doc.get("created_at") else "N/A"
+        kind = f"💰 ₹{doc.get('price', 0):.2f} | 🛒 {doc.get('sales_count', 0)} sales" if doc.get("is_paid") else "🆓 Free"
+        lines.append(f"• `{doc['_id']}` — {get_batch_file_count(doc)} file(s) | {kind} | {created}")
+    buttons = []
+    if after:
+        buttons.append(InlineKeyboardButton("⏮ First", callback_data="mylinks_first"))
+    if next_cursor:
+        created_at, batch_id = next_cursor
+        # BSON dates have millisecond precision, so the cursor round-trips exactly as epoch ms
+        cursor_ms = int(created_at.replace(tzinfo=timezone.utc).timestamp() * 1000)
+        buttons.append(InlineKeyboardButton("Next ➡️", callback_data=f"mylinks_{cursor_ms}_{batch_id}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+@app.on_message(filters.command("mylinks") & filters.private)
+async def mylinks_command(client: Client, message: Message):
+    text, keyboard = render_owner_links_page(message.from_user.id)
+    await message.reply(text, reply_markup=keyboard)
+
+@app.on_callback_query(filters.regex(r"^mylinks_"))
+async def mylinks_callback(client: Client, query: CallbackQuery):
+    after = None
+    if query.data != "mylinks_first":
+        try:
+            _, cursor_ms, batch_id = query.data.split("_", 2)
+            after = (datetime.fromtimestamp(int(cursor_ms) / 1000, tz=timezone.utc), batch_id)
+        except ValueError:
+            await query.answer("Invalid page.", show_alert=True)
+            return
+    text, keyboard = render_owner_links_page(query.from_user.id, after)
+    try:
+        await query.message.edit_text(text, reply_markup=keyboard)
+    except MessageNotModified:
+        pass
+    await query.answer()
+
+# -------------------------
+# Inline search (@bot <query>) over an owner's own batches
+# -------------------------
+_inline_cache = {}  # {owner_id: {query: (docs, expires_at)}}; dropped when the owner creates or edits a link
+INLINE_CACHE_MAX_ENTRIES = 5000  # across all owners
+_inline_cache_swept = {"at": 0.0}
+
+def _sweep_inline_cache():
+    """Drop expired entries (at most once per INLINE_CACHE_SECONDS); clear everything if still over the cap."""
+    now = time.monotonic()
+    if now - _inline_cache_swept["at"] < INLINE_CACHE_SECONDS:
+        return
+    _inline_cache_swept["at"] = now
+    for owner_id, owner_cache in list(_inline_cache.items()):
+        for key in [k for k, (_, expires_at) in owner_cache.items() if expires_at <= now]:
+            owner_cache.pop(key, None)
+        if not owner_cache:
+            _inline_cache.pop(owner_id, None)
+    if sum(len(owner_cache) for owner_cache in _inline_cache.values()) > INLINE_CACHE_MAX_ENTRIES:
+        _inline_cache.clear()
+
+def get_share_link(batch_id: str) -> str:
+    return f"https://krpicture0.blogspot.com?start={batch_id}"
+
+def search_owner_batches(owner_id: int, text: str) -> list:
+    """Owner's batches matching `text` on file names (best match first); newest batches for an empty query."""
+    key = text.lower()
+    cached = _inline_cache.get(owner_id, {}).get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    # render_inline_result shows at most 4 names; big batches carry thousands
+    projection = {"file_names": {"$slice": 4}, "is_paid": 1, "price": 1, "message_ranges": 1, "message_ids": 1}
+    if text:
+        projection["score"] = {"$meta": "textScore"}
+        cursor = files_collection.find({"owner_id": owner_id, "$text": {"$search": text}}, projection)
+        docs = list(cursor.sort([("score", {"$meta": "textScore"})]).limit(INLINE_RESULTS_LIMIT))
+    else:
+        cursor = files_collection.find({"owner_id": owner_id}, projection)
+        docs = list(cursor.sort([("created_at", -1), ("_id", -1)]).limit(INLINE_RESULTS_LIMIT))
+    _sweep_inline_cache()
+    owner_cache = _inline_cache.setdefault(owner_id, {})
+    if len(owner_cache) > 50:
+        owner_cache.clear()
+    owner_cache[key] = (docs, time.monotonic() + INLINE_CACHE_SECONDS)
+    return docs
+
+def render_inline_result(doc: dict) -> InlineQueryResultArticle:
+    names = [name for name in doc.get("file_names") or [] if name]
+    kind = f"💰 Paid ₹{doc.get('price', 0):.2f}" if doc.get("is_paid") else "🆓 Free"
+    share_link = get_share_link(doc["_id"])
+    return InlineQueryResultArticle(
+        title=names[0] if names else f"Batch {doc['_id']}",
+        description=f"{kind} | {get_batch_file_count(doc)} file(s)" + (f" | {', '.join(names[1:4])}" if len(names) > 1 else ""),
+        input_message_content=InputTextMessageContent(share_link, disable_web_page_preview=True),
+        id=doc["_id"],
+    )
+
+@app.on_inline_query()
+async def inline_search_handler(client: Client, inline_query: InlineQuery):
+    if not services_ready.is_set() or runtime_state["draining"]:
+        return
+    try:
+        docs = search_owner_batches(inline_query.from_user.id, inline_query.query.strip())
+    except Exception as e:
+        logging.warning("Inline search failed for %s: %s", inline_query.from_user.id, e)
+        docs = []
+    try:
+        # is_personal: results differ per owner, so Telegram must not share its cache between users
+        await inline_query.answer([render_inline_result(doc) for doc in docs], cache_time=INLINE_CACHE_SECONDS, is_personal=True)
+    except Exception as e:
+        logging.warning("Could not answer inline query: %s", e)
+
+# -------------------------
+# Buyer entitlements (paid batches a buyer already owns)
+# -------------------------
+_entitlement_cache = {}  # {(buyer_id, batch_id): (entitled, expires_at)}
+
+def has_entitlement(buyer_id: int, batch_id: str) -> bool:
+    key = (buyer_id, batch_id)
+    cached = _entitlement_cache.get(key)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    if len(_entitlement_cache) > 10000:
+        now = time.monotonic()
+        for stale in [k for k, (_, expires_at) in _entitlement_cache.items() if expires_at <= now]:
+            _entitlement_cache.pop(stale, None)
+    entitled = entitlements_collection.find_one({"buyer_id": buyer_id, "batch_id": batch_id}, {"_id": 1}) is not None
+    _entitlement_cache[key] = (entitled, time.monotonic() + ENTITLEMENT_CACHE_SECONDS)
+    return entitled
+
+def grant_entitlement(buyer_id: int, batch_id: str, payment_id: str, amount: str):
+    try:
+        entitlements_collection.update_one(
+            {"buyer_id": buyer_id, "batch_id": batch_id},
+            {"$setOnInsert": {"payment_id": payment_id, "amount": amount, "created_at": datetime.now(timezone.utc)}},
+            upsert=True)
+        _entitlement_cache[(buyer_id, batch_id)] = (True, time.monotonic() + ENTITLEMENT_CACHE_SECONDS)
+    except Exception as e:
+        logging.warning("Could not record entitlement of %s to %s: %s", buyer_id, batch_id, e)
+
 # -------------------------
 # Payment & link processing
 # -------------------------
 async def process_link_click(client: Client, user_id: int, batch_id: str):
-    batch_record = files_collection.find_one({"_id": batch_id})
+    batch_record = files_collection.find_one({"_id": batch_id}, BATCH_READ_PROJECTION)
     if not batch_record:
         try:
             await client.send_message(user_id, "__🤔 **Link Expired or Invalid**__")
         except Exception:
             pass
         return
+    record_batch_event(batch_id, clicks=1)
 
     if not batch_record.get("is_paid", False):
         await send_files_from_batch(client, user_id, batch_record, FREE_DELETE_DELAY_MINUTES, "Minutes")
         return
 
-    # paid flow: allocate unique amount (base price + cents)
-    base_price = float(batch_record.get("price", 0))
-    pending_amounts = {p["unique_amount"] for p in payments_collection.find({}, {"unique_amount": 1})}
-    unique_amount_str = None
-    # try up to 500 variations
-    for i in range(1, 500):
-        temp_amount = f"{base_price + (i / 100.0):.2f}"
-        if temp_amount not in pending_amounts:
-            unique_amount_str = temp_amount
-            break
-    if not unique_amount_str:
-        await client.send_message(user_id, "__🚦 Sorry, the server is busy. Please try again in a minute.__")
+    if has_entitlement(user_id, batch_id):
+        # already bought: re-deliver without a new payment, expiry job or seller approval
+        try:
+            await client.send_message(user_id, "__✅ You Already Own This Batch. Sending Your Files Again...__")
+        except Exception:
+            pass
+        await send_files_from_batch(client, user_id, batch_record, PAID_DELETE_DELAY_HOURS, "Hours")
+        record_batch_event(batch_id, redeliveries=1)
         return
 
+    # paid flow: the payment_id doubles as the trace id for the whole purchase pipeline
     payment_id = generate_random_string(12)
-    payments_collection.insert_one({
-        "_id": payment_id,
-        "batch_id": batch_id,
-        "buyer_id": user_id,
-        "unique_amount": unique_amount_str,
-        "created_at": datetime.now(timezone.utc)
-    })
-
-    # schedule expiration
-    run_time = datetime.now(IST) + timedelta(minutes=PAYMENT_EXPIRATION_MINUTES)
-    try:
-        scheduler.add_job(expire_payment_job, "date", run_date=run_time, args=[payment_id, user_id, batch_id], id=payment_id, replace_existing=True)
-    except Exception as e:
-        logging.warning("Could not schedule payment expiration job: %s", e)
-
-    bot_username = (await client.get_me()).username
-    payee_name = quote_plus(batch_record.get("payee_name", "Seller"))
-    upi_id = batch_record.get("upi_id", "")
-    payment_url = f"{PAYMENT_PAGE_URL}?amount={unique_amount_str}&upi={upi_id}&name={payee_name}&bot={bot_username}"
-    pay_btn = InlineKeyboardButton("💰 Pay Now", url=payment_url)
-    paid_btn = InlineKeyboardButton("✅ I Have Paid", callback_data=f"i_paid_{payment_id}")
-
-    await client.send_message(
-        user_id,
-        f"**__🔒 This Is A Premium File Batch.__**\n\n**__IMPORTANT:__** __Pay the **EXACT AMOUNT** shown below. This session will expire in **{PAYMENT_EXPIRATION_MINUTES} minutes**.__\n\n__💰 **Amount To Pay:** `₹{unique_amount_str}`__\n\n__Click **'Pay Now'**, then click **'I Have Paid'** to request access.__",
-        reply_markup=InlineKeyboardMarkup([[pay_btn], [paid_btn]])
-    )
+    with trace_span("process_link_click", trace_id=payment_id, batch_id=batch_id, buyer_id=user_id):
+        # allocate unique amount (base price + cents)
+        with trace_span("allocate_amount") as span:
+            base_price = float(batch_record.get("price", 0))
+            pending_amounts = {p["unique_amount"] for p in payments_collection.find({}, {"unique_amount": 1})}
+            unique_amount_str = None
+            # try up to 500 variations
+            for i in range(1, 500):
+                temp_amount = f"{base_price + (i / 100.0):.2f}"
+                if temp_amount not in pending_amounts:
+                    unique_amount_str = temp_amount
+                    break
+            span["pending"] = len(pending_amounts)
+            span["amount"] = unique_amount_str
+        if not unique_amount_str:
+            await client.send_message(user_id, "__🚦 Sorry, the server is busy. Please try again in a minute.__")
+            return
+
+        with trace_span("insert_payment"):
+            payments_collection.insert_one({
+                "_id": payment_id,
+                "batch_id": batch_id,
+                "buyer_id": user_id,
+                "unique_amount": unique_amount_str,
+                "created_at": datetime.now(timezone.utc)
+            })
+
+        # schedule expiration
+        run_time = datetime.now(IST) + timedelta(minutes=PAYMENT_EXPIRATION_MINUTES)
+        with trace_span("schedule_expiry"):
+            try:
+                scheduler.add_job(expire_payment_job, "date", run_date=run_time, args=[payment_id, user_id, batch_id], id=payment_id, replace_existing=True)
+            except Exception as e:
+                logging.warning("Could not schedule payment expiration job: %s", e)
+
+        with trace_span("send_payment_prompt"):
+            bot_username = (await client.get_me()).username
+            payee_name = quote_plus(batch_record.get("payee_name", "Seller"))
+            upi_id = batch_record.get("upi_id", "")
+            payment_url = f"{PAYMENT_PAGE_URL}?amount={unique_amount_str}&upi={upi_id}&name={payee_name}&bot={bot_username}"
+            pay_btn = InlineKeyboardButton("💰 Pay Now", url=payment_url)
+            paid_btn = InlineKeyboardButton("✅ I Have Paid", callback_data=f"i_paid_{payment_id}")
+
+            await client.send_message(
+                user_id,
+                f"**__🔒 This Is A Premium File Batch.__**\n\n**__IMPORTANT:__** __Pay the **EXACT AMOUNT** shown below. This session will expire in **{PAYMENT_EXPIRATION_MINUTES} minutes**.__\n\n__💰 **Amount To Pay:** `₹{unique_amount_str}`__\n\n__Click **'Pay Now'**, then click **'I Have Paid'** to request access.__",
+                reply_markup=InlineKeyboardMarkup([[pay_btn], [paid_btn]])
+            )
 
 @app.on_callback_query(filters.regex(r"^i_paid_"))
 async def i_have_paid_callback(client: Client, query: CallbackQuery):
@@ -881,102 +2304,130 @@ async def i_have_paid_callback(client: Client, query: CallbackQuery):
         await query.answer("__Invalid request.__", show_alert=True)
         return
 
-    # cancel expiration job (if exists)
-    try:
-        scheduler.remove_job(payment_id)
-    except JobLookupError:
-        pass
-    except Exception as e:
-        logging.warning("Error removing payment expiration job: %s", e)
-
-    payment_record = payments_collection.find_one({"_id": payment_id})
-    if not payment_record:
-        await query.answer("__This payment session has expired. Please generate a new payment link.__", show_alert=True)
-        return
+    with trace_span("i_have_paid_callback", trace_id=payment_id):
+        # cancel expiration job (if exists)
+        try:
+            scheduler.remove_job(payment_id)
+        except JobLookupError:
+            pass
+        except Exception as e:
+            logging.warning("Error removing payment expiration job: %s", e)
 
-    batch_id = payment_record["batch_id"]
-    batch_record = files_collection.find_one({"_id": batch_id})
-    if not batch_record:
-        await query.answer("__The File Batch Linked To This Payment Is No Longer Available.__", show_alert=True)
-        return
+        payment_record = payments_collection.find_one({"_id": payment_id})
+        if not payment_record:
+            await query.answer("__This payment session has expired. Please generate a new payment link.__", show_alert=True)
+            return
 
-    owner_id = batch_record["owner_id"]
-    # schedule owner approval expiration
-    run_time = datetime.now(IST) + timedelta(hours=APPROVAL_EXPIRATION_HOURS)
-    try:
-        scheduler.add_job(expire_approval_job, "date", run_date=run_time, args=[payment_id, query.from_user.id, owner_id], id=f"approve_{payment_id}", replace_existing=True)
-    except Exception as e:
-        logging.warning("Could not schedule approval expiration job: %s", e)
+        batch_id = payment_record["batch_id"]
+        batch_record = files_collection.find_one({"_id": batch_id}, BATCH_READ_PROJECTION)
+        if not batch_record:
+            await query.answer("__The File Batch Linked To This Payment Is No Longer Available.__", show_alert=True)
+            return
 
-    await query.answer("__✅ Request Sent To The Seller. You Will Get The Files After Approval.__", show_alert=True)
-    try:
-        await query.message.edit_reply_markup(None)
-    except Exception:
-        pass
+        owner_id = batch_record["owner_id"]
+        # schedule owner approval expiration
+        run_time = datetime.now(IST) + timedelta(hours=APPROVAL_EXPIRATION_HOURS)
+        try:
+            scheduler.add_job(expire_approval_job, "date", run_date=run_time, args=[payment_id, query.from_user.id, owner_id], id=f"approve_{payment_id}", replace_existing=True)
+        except Exception as e:
+            logging.warning("Could not schedule approval expiration job: %s", e)
 
-    approve_btn = InlineKeyboardButton("✅ Approve", callback_data=f"approve_{payment_id}")
-    decline_btn = InlineKeyboardButton("❌ Decline", callback_data=f"decline_{payment_id}")
+        await query.answer("__✅ Request Sent To The Seller. You Will Get The Files After Approval.__", show_alert=True)
+        try:
+            await query.message.edit_reply_markup(None)
+        except Exception:
+            pass
 
-    try:
         buyer_user = query.from_user
-        await client.send_message(
-            owner_id,
-            f"__🔔 **Payment Request**\n\n**User:** {buyer_user.mention} (`{buyer_user.id}`)\n**Batch ID:** `{batch_id}`\n\nThey Claim To Have Paid The Unique Amount Of **`₹{payment_record['unique_amount']}`**.\n\nPlease check your account for this **exact amount** and click **Approve**.__",
-            reply_markup=InlineKeyboardMarkup([[approve_btn], [decline_btn]])
-        )
-    except Exception as e:
-        logging.warning("Could Not Send Notification To Owner %s: %s", owner_id, e)
+        if is_digest_owner(owner_id):
+            queue_owner_digest(owner_id, "approvals", {
+                "payment_id": payment_id,
+                "buyer": f"{buyer_user.mention} (`{buyer_user.id}`)",
+                "batch_id": batch_id,
+                "amount": payment_record["unique_amount"],
+            })
+            return
 
-async def process_payment_approval(payment_id: str, approved_by: str = "Seller (Manual)"):
-    # cancel approval expiration job
-    try:
-        scheduler.remove_job(f"approve_{payment_id}")
-    except JobLookupError:
-        pass
-    except Exception as e:
-        logging.warning("Error removing approval job: %s", e)
+        approve_btn = InlineKeyboardButton("✅ Approve", callback_data=f"approve_{payment_id}")
+        decline_btn = InlineKeyboardButton("❌ Decline", callback_data=f"decline_{payment_id}")
 
-    payment_record = payments_collection.find_one({"_id": payment_id})
-    if not payment_record:
-        logging.warning("Approval failed: payment record not found %s", payment_id)
-        return "__This Payment Request Has Expired Or Is Invalid.__"
+        try:
+            await client.send_message(
+                owner_id,
+                f"__🔔 **Payment Request**\n\n**User:** {buyer_user.mention} (`{buyer_user.id}`)\n**Batch ID:** `{batch_id}`\n\nThey Claim To Have Paid The Unique Amount Of **`₹{payment_record['unique_amount']}`**.\n\nPlease check your account for this **exact amount** and click **Approve**.__",
+                reply_markup=InlineKeyboardMarkup([[approve_btn], [decline_btn]])
+            )
+        except Exception as e:
+            logging.warning("Could Not Send Notification To Owner %s: %s", owner_id, e)
 
-    batch_id = payment_record["batch_id"]
-    buyer_id = payment_record["buyer_id"]
-    unique_amount = payment_record["unique_amount"]
-    batch_record = files_collection.find_one({"_id": batch_id})
-    if not batch_record:
-        payments_collection.delete_one({"_id": payment_id})
-        logging.error("Critical: Batch %s not found for payment %s. Deleted payment.", batch_id, payment_id)
-        return f"__Error: The file batch `{batch_id}` no longer exists. Payment record deleted.__"
+async def process_payment_approval(payment_id: str, approved_by: str = "Seller (Manual)"):
+    with trace_span("process_payment_approval", trace_id=payment_id, approved_by=approved_by) as span:
+        # cancel approval expiration job
+        try:
+            scheduler.remove_job(f"approve_{payment_id}")
+        except JobLookupError:
+            pass
+        except Exception as e:
+            logging.warning("Error removing approval job: %s", e)
 
-    owner_id = batch_record["owner_id"]
-    delivered = await send_files_from_batch(app, buyer_id, batch_record, PAID_DELETE_DELAY_HOURS, "Hours")
+        # claim the payment before delivering: once delivery starts it must not stay matchable by
+        # shortcut_webhook, even if a restart interrupts the rest of this function
+        payment_record = payments_collection.find_one_and_delete({"_id": payment_id})
+        if not payment_record:
+            logging.warning("Approval failed: payment record not found %s", payment_id)
+            return "__This Payment Request Has Expired Or Is Invalid.__"
 
-    try:
-        if delivered and approved_by.startswith("Automation"):
-            await app.send_message(buyer_id, f"__✅ Your payment of `₹{unique_amount}` has been automatically approved! You are receiving the files.__")
-    except Exception:
-        pass
+        batch_id = payment_record["batch_id"]
+        buyer_id = payment_record["buyer_id"]
+        unique_amount = payment_record["unique_amount"]
+        batch_record = files_collection.find_one({"_id": batch_id}, BATCH_READ_PROJECTION)
+        if not batch_record:
+            logging.error("Critical: Batch %s not found for payment %s. Deleted payment.", batch_id, payment_id)
+            return f"__Error: The file batch `{batch_id}` no longer exists. Payment record deleted.__"
+
+        owner_id = batch_record["owner_id"]
+        # record the purchase first, so a buyer whose delivery fails can still fetch the files later from the link
+        grant_entitlement(buyer_id, batch_id, payment_id, unique_amount)
+        files_collection.update_one({"_id": batch_id}, {"$inc": {"sales_count": 1}})
+        record_batch_event(batch_id, sales=1, revenue=float(unique_amount))
+        delivered = await send_files_from_batch(app, buyer_id, batch_record, PAID_DELETE_DELAY_HOURS, "Hours")
+        span["delivered"] = delivered
+        if delivered is None:
+            # drain() handed the rest of the delivery to the next process, which finishes it
+            logging.info("Delivery for payment %s handed off mid-way; it resumes after restart.", payment_id)
+            return f"__✅ Payment Of `₹{unique_amount}` Approved For User `{buyer_id}`. Delivery resumes after a restart.__"
 
-    final_message_for_button = ""
-    try:
-        if delivered:
-            success_message = (
-                f"__**✅ Files Delivered Successfully!**\n\n**Approved By:** {approved_by}\n**Buyer:** `{buyer_id}`\n**Batch ID:** `{batch_id}`\n**Amount:** `₹{unique_amount}`__"
-            )
-            await app.send_message(owner_id, success_message)
-            final_message_for_button = f"__✅ Payment Of `₹{unique_amount}` Approved For User `{buyer_id}`. Files have been sent.__"
+        try:
+            if delivered and approved_by.startswith("Automation"):
+                await app.send_message(buyer_id, f"__✅ Your payment of `₹{unique_amount}` has been automatically approved! You are receiving the files.__")
+        except Exception:
+            pass
+
+        final_message_for_button = ""
+        if is_digest_owner(owner_id):
+            queue_owner_digest(owner_id, "deliveries", {
+                "buyer_id": buyer_id, "batch_id": batch_id, "amount": unique_amount,
+                "delivered": delivered, "approved_by": approved_by,
+            })
+            final_message_for_button = (f"__✅ Payment Of `₹{unique_amount}` Approved For User `{buyer_id}`. Files have been sent.__" if delivered
+                                        else f"__❌ **Delivery Failed!** The user `{buyer_id}` might have blocked the bot.__")
         else:
-            fail_message = f"__❌ **Delivery Failed!** The user `{buyer_id}` might have blocked the bot.__"
-            await app.send_message(owner_id, fail_message)
-            final_message_for_button = fail_message
-    except Exception as e:
-        logging.warning("Could not send notification to owner %s: %s", owner_id, e)
-        final_message_for_button = "__An error occurred while notifying the owner.__"
+            try:
+                if delivered:
+                    success_message = (
+                        f"__**✅ Files Delivered Successfully!**\n\n**Approved By:** {approved_by}\n**Buyer:** `{buyer_id}`\n**Batch ID:** `{batch_id}`\n**Amount:** `₹{unique_amount}`__"
+                    )
+                    await app.send_message(owner_id, success_message)
+                    final_message_for_button = f"__✅ Payment Of `₹{unique_amount}` Approved For User `{buyer_id}`. Files have been sent.__"
+                else:
+                    fail_message = f"__❌ **Delivery Failed!** The user `{buyer_id}` might have blocked the bot.__"
+                    await app.send_message(owner_id, fail_message)
+                    final_message_for_button = fail_message
+            except Exception as e:
+                logging.warning("Could not send notification to owner %s: %s", owner_id, e)
+                final_message_for_button = "__An error occurred while notifying the owner.__"
 
-    payments_collection.delete_one({"_id": payment_id})
-    return final_message_for_button
+        return final_message_for_button
 
 @app.on_callback_query(filters.regex(r"^(approve|decline)_"))
 async def payment_verification_callback(client: Client, query: CallbackQuery):
@@ -984,105 +2435,847 @@ async def payment_verification_callback(client: Client, query: CallbackQuery):
         action, payment_id = query.data.split("_", 1)
     except Exception:
         return
-    owner_id = query.from_user.id
-    payment_record = payments_collection.find_one({"_id": payment_id})
-    if not payment_record:
-        await query.answer("__This Payment Request Has Expired Or Is Invalid.__", show_alert=True)
-        return
-    batch_record = files_collection.find_one({"_id": payment_record["batch_id"]})
-    if not batch_record or batch_record["owner_id"] != owner_id:
-        await query.answer("__This Is Not For You.__", show_alert=True)
-        return
+    with trace_span("payment_verification_callback", trace_id=payment_id, action=action):
+        owner_id = query.from_user.id
+        payment_record = payments_collection.find_one({"_id": payment_id})
+        if not payment_record:
+            await query.answer("__This Payment Request Has Expired Or Is Invalid.__", show_alert=True)
+            return
+        batch_record = files_collection.find_one({"_id": payment_record["batch_id"]}, BATCH_READ_PROJECTION)
+        if not batch_record or batch_record["owner_id"] != owner_id:
+            await query.answer("__This Is Not For You.__", show_alert=True)
+            return
 
-    if action == "approve":
-        result_message = await process_payment_approval(payment_id, approved_by="Seller (Manual)")
-        try:
+        if action == "approve":
+            result_message = await process_payment_approval(payment_id, approved_by="Seller (Manual)")
+            try:
+                await query.message.edit_text(result_message)
+            except MessageNotModified:
+                pass
+        else:
+            result_message = await process_payment_decline(payment_record)
             await query.message.edit_text(result_message)
-        except MessageNotModified:
-            pass
-    else:
+
+async def process_payment_decline(payment_record: dict) -> str:
+    """Cancel the approval timer, tell the buyer and drop the payment; returns the owner-facing summary."""
+    payment_id = payment_record["_id"]
+    with trace_span("process_payment_decline", trace_id=payment_id):
         try:
             scheduler.remove_job(f"approve_{payment_id}")
         except JobLookupError:
             pass
         buyer_id = payment_record["buyer_id"]
         unique_amount = payment_record["unique_amount"]
-        await query.message.edit_text(f"__❌ Payment Of `₹{unique_amount}` Declined For User `{buyer_id}`.__")
         try:
-            await client.send_message(buyer_id, "__😔 **Payment Declined**\nThe Seller Could Not Verify Your Payment.__")
+            await app.send_message(buyer_id, "__😔 **Payment Declined**\nThe Seller Could Not Verify Your Payment.__")
         except Exception:
             pass
         payments_collection.delete_one({"_id": payment_id})
+        return f"__❌ Payment Of `₹{unique_amount}` Declined For User `{buyer_id}`.__"
 
-async def send_files_from_batch(client, user_id: int, batch_record: dict, delay_amount: int, delay_unit: str):
-    """Copies files from LOG_CHANNEL to the user, adds warning caption and schedules deletion."""
+async def send_files_from_batch(client, user_id: int, batch_record: dict, delay_amount: int, delay_unit: str, start_index: int = 0):
+    """
+    Copies files from their storage channels to the user, adds warning caption and schedules deletion.
+    Returns True/False for full/partial success, or None if drain() handed the rest to the next process.
+    """
+    file_count = get_batch_file_count(batch_record)
+    # progress is visible to drain() so an unfinished delivery can be handed to the next process
+    progress = {"user_id": user_id, "batch_id": batch_record["_id"], "delay_amount": delay_amount,
+                "delay_unit": delay_unit, "next_index": start_index}
+    # the delivery gets its own task: the caller may be a long-lived Pyrogram dispatcher worker,
+    # which drain() must neither wait for nor cancel
+    task = asyncio.create_task(_send_files_from_batch(client, user_id, batch_record, delay_amount, delay_unit, file_count, progress))
+    inflight_deliveries[task] = progress
+    task.add_done_callback(lambda t: inflight_deliveries.pop(t, None))
     try:
-        await client.send_message(user_id, f"__✅ Access Granted! You Are Receiving **{len(batch_record.get('message_ids', []))}** Files.__")
-    except Exception:
-        pass
-
-    all_sent_successfully = True
-    for msg_id in batch_record.get("message_ids", []):
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # Task.cancelling() is 3.11+; before that, the shield means a cancelled caller leaves the
+        # delivery task itself running, so task.cancelled() alone points at drain()
+        cancelling = getattr(asyncio.current_task(), "cancelling", None)
+        if task.cancelled() and not (cancelling and cancelling()):
+            return None  # handed off by drain(); the caller itself was not cancelled
+        raise
+
+async def _send_files_from_batch(client, user_id: int, batch_record: dict, delay_amount: int, delay_unit: str, file_count: int, progress: dict):
+    start_index = progress["next_index"]
+    with trace_span("send_files_from_batch", files=file_count):
         try:
-            sent_msg = await client.copy_message(chat_id=user_id, from_chat_id=LOG_CHANNEL, message_id=msg_id)
-            if sent_msg is None:
-                logging.warning("send_files_from_batch: log message %s returned None", msg_id)
-                continue
-            warning_text = f"\n\n\n__**⚠️ IMPORTANT!**\n\nThese Files Will Be **Automatically Deleted In {delay_amount} {delay_unit}**. Please Forward Them To Your **Saved Messages** Immediately.__"
+            if start_index:
+                await client.send_message(user_id, f"__♻️ Resuming Your Delivery: **{file_count - start_index}** Of **{file_count}** Files Left.__")
+            else:
+                await client.send_message(user_id, f"__✅ Access Granted! You Are Receiving **{file_count}** Files.__")
+        except Exception:
+            pass
+
+        all_sent_successfully = True
+        for index, (chat_id, msg_id) in enumerate(islice(iter_batch_files(batch_record), start_index, None), start_index):
+            progress["next_index"] = index
             try:
-                if getattr(sent_msg, "caption", None) is not None:
-                    await sent_msg.edit_caption((sent_msg.caption or "") + warning_text)
-                else:
-                    await sent_msg.reply(warning_text, quote=True)
-            except Exception:
+                sender, sent_msg = await delivery_copy_message(user_id, chat_id, msg_id)
+                if sent_msg is None:
+                    logging.warning("send_files_from_batch: log message %s returned None", msg_id)
+                    continue
+                warning_text = f"\n\n\n__**⚠️ IMPORTANT!**\n\nThese Files Will Be **Automatically Deleted In {delay_amount} {delay_unit}**. Please Forward Them To Your **Saved Messages** Immediately.__"
                 try:
-                    await client.send_message(user_id, warning_text)
+                    if getattr(sent_msg, "caption", None) is not None:
+                        await sent_msg.edit_caption((sent_msg.caption or "") + warning_text)
+                    else:
+                        await sent_msg.reply(warning_text, quote=True)
+                except Exception:
+                    try:
+                        await sender.send_message(user_id, warning_text)
+                    except Exception:
+                        pass
+
+                # schedule deletion
+                run_time = datetime.now(IST) + (timedelta(minutes=delay_amount) if delay_unit == "Minutes" else timedelta(hours=delay_amount))
+                try:
+                    scheduler.add_job(delete_message_job, "date", run_date=run_time, args=[sent_msg.chat.id, [sent_msg.id], sender.name], misfire_grace_time=300)
+                except Exception as e:
+                    logging.warning("Failed to schedule delete job for message %s: %s", getattr(sent_msg, "id", None), e)
+
+            except (UserIsBlocked, InputUserDeactivated):
+                all_sent_successfully = False
+                logging.warning("Failed to send file to %s: blocked/deactivated", user_id)
+                break
+            except Exception as e:
+                all_sent_successfully = False
+                logging.exception("Error sending file %s to %s: %s", msg_id, user_id, e)
+                try:
+                    await client.send_message(user_id, "__❌ Could Not Send One Of The Files. It Might Have Been Deleted From The Source.__")
                 except Exception:
                     pass
+        progress["next_index"] = file_count
+        record_batch_event(batch_record["_id"], **({"deliveries": 1} if all_sent_successfully else {"delivery_failures": 1}))
+        return all_sent_successfully
+
+# -------------------------
+# Owner payment digests
+# -------------------------
+# Owners who enable /digest get one message per DIGEST_WINDOW_SECONDS listing the
+# approval requests and delivery confirmations that came in, instead of one message
+# each. Bulk actions go through process_payment_approval / process_payment_decline.
+# Sent digests with open approvals are saved in `digests` so their buttons survive a
+# restart; drain() sends the digests still waiting for their window.
+owner_digests = {}    # {owner_id: {"approvals": [item], "deliveries": [item], "task": asyncio.Task}}
+digest_messages = {}  # {digest_id: {"owner_id": id, "items": [approval item], "deliveries": [item], "selected": set(payment_id)}}
+_digest_owner_cache = {}  # {owner_id: (enabled, expires_at)}
+
+def is_digest_owner(owner_id: int) -> bool:
+    cached = _digest_owner_cache.get(owner_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    doc = users_collection.find_one({"_id": owner_id}, {"digest_mode": 1}) or {}
+    enabled = bool(doc.get("digest_mode"))
+    _digest_owner_cache[owner_id] = (enabled, time.monotonic() + 60)
+    return enabled
+
+def queue_owner_digest(owner_id: int, kind: str, item: dict):
+    digest = owner_digests.setdefault(owner_id, {"approvals": [], "deliveries": [], "task": None})
+    digest[kind].append(item)
+    if len(digest["approvals"]) + len(digest["deliveries"]) >= DIGEST_MAX_ITEMS:
+        if digest["task"] and not digest["task"].done():
+            digest["task"].cancel()
+        digest["task"] = asyncio.create_task(flush_owner_digest(owner_id, delay=0))
+    elif not digest["task"] or digest["task"].done():
+        digest["task"] = asyncio.create_task(flush_owner_digest(owner_id, delay=DIGEST_WINDOW_SECONDS))
+
+def render_digest(digest_id: str, selecting: bool = False):
+    record = digest_messages[digest_id]
+    items, selected = record["items"], record["selected"]
+    lines = ["__🔔 **Payment Digest**__"]
+    if items:
+        lines.append(f"\n__**Pending Approvals ({len(items)}):** check your account for these **exact amounts**.__")
+        for idx, item in enumerate(items, 1):
+            lines.append(f"{idx}. `₹{item['amount']}` — {item['buyer']} — batch `{item['batch_id']}`")
+    deliveries = record.get("deliveries", [])
+    if deliveries:
+        ok = sum(1 for d in deliveries if d["delivered"])
+        lines.append(f"\n__**Deliveries:** ✅ `{ok}` delivered, ❌ `{len(deliveries) - ok}` failed__")
+        for d in deliveries:
+            lines.append(f"{'✅' if d['delivered'] else '❌'} `₹{d['amount']}` → `{d['buyer_id']}` (batch `{d['batch_id']}`, {d['approved_by']})")
+    buttons = []
+    if items and selecting:
+        for idx, item in enumerate(items):
+            mark = "☑️" if item["payment_id"] in selected else "⬜️"
+            buttons.append([InlineKeyboardButton(f"{mark} {idx + 1}. ₹{item['amount']}", callback_data=f"digest_t_{digest_id}_{idx}")])
+        buttons.append([InlineKeyboardButton(f"✅ Approve Selected ({len(selected)})", callback_data=f"digest_ok_{digest_id}"),
+                        InlineKeyboardButton(f"❌ Decline Selected ({len(selected)})", callback_data=f"digest_no_{digest_id}")])
+        buttons.append([InlineKeyboardButton("🔙 Back", callback_data=f"digest_back_{digest_id}")])
+    elif items:
+        buttons.append([InlineKeyboardButton(f"✅ Approve All ({len(items)})", callback_data=f"digest_all_{digest_id}")])
+        buttons.append([InlineKeyboardButton("☑️ Approve Selected", callback_data=f"digest_pick_{digest_id}")])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons) if buttons else None
+
+def get_digest_record(digest_id: str):
+    record = digest_messages.get(digest_id)
+    if record is None:
+        # sent by an earlier process
+        doc = digests_collection.find_one({"_id": digest_id})
+        if doc:
+            record = digest_messages[digest_id] = {"owner_id": doc["owner_id"], "items": doc.get("items", []),
+                                                   "deliveries": doc.get("deliveries", []), "selected": set()}
+    return record
+
+def save_digest_record(digest_id: str):
+    """Persist the digest while it still has approvals to act on; forget it once it has none."""
+    record = digest_messages.get(digest_id)
+    try:
+        if record and record["items"]:
+            digests_collection.update_one({"_id": digest_id}, {
+                "$set": {"owner_id": record["owner_id"], "items": record["items"], "deliveries": record["deliveries"]},
+                "$setOnInsert": {"created_at": datetime.now(timezone.utc)}}, upsert=True)
+        else:
+            digest_messages.pop(digest_id, None)
+            digests_collection.delete_one({"_id": digest_id})
+    except Exception as e:
+        logging.warning("Could not save payment digest %s: %s", digest_id, e)
+
+async def flush_owner_digest(owner_id: int, delay: float = 0):
+    if delay:
+        await asyncio.sleep(delay)
+    digest = owner_digests.pop(owner_id, None)
+    if not digest or not (digest["approvals"] or digest["deliveries"]):
+        return
+    digest_id = generate_random_string(8)
+    digest_messages[digest_id] = {"owner_id": owner_id, "items": digest["approvals"], "deliveries": digest["deliveries"], "selected": set()}
+    text, keyboard = render_digest(digest_id)
+    try:
+        await app.send_message(owner_id, text, reply_markup=keyboard)
+    except Exception as e:
+        logging.warning("Could not send payment digest to owner %s: %s", owner_id, e)
+    # delivery confirmations are informational only; keep the record while approvals are actionable
+    save_digest_record(digest_id)
+
+async def flush_all_owner_digests():
+    """Send every digest still waiting for its window now (used by drain())."""
+    for digest in owner_digests.values():
+        if digest["task"] and not digest["task"].done():
+            digest["task"].cancel()
+    await asyncio.gather(*(flush_owner_digest(owner_id) for owner_id in list(owner_digests)), return_exceptions=True)
+
+async def _run_digest_action(payment_ids: list, approve: bool) -> Counter:
+    """Approve or decline payments through the normal path, a few at a time."""
+    results = Counter()
+    sem = asyncio.Semaphore(5)
+
+    async def _one(payment_id: str):
+        async with sem:
+            payment_record = payments_collection.find_one({"_id": payment_id})
+            if not payment_record:
+                results["expired"] += 1
+                return
+            if approve:
+                await process_payment_approval(payment_id, approved_by="Seller (Digest)")
+                results["approved"] += 1
+            else:
+                await process_payment_decline(payment_record)
+                results["declined"] += 1
+    await asyncio.gather(*(_one(pid) for pid in payment_ids))
+    return results
+
+@app.on_callback_query(filters.regex(r"^digest_"))
+async def digest_callback(client: Client, query: CallbackQuery):
+    parts = query.data.split("_")
+    action, digest_id = parts[1], parts[2] if len(parts) > 2 else ""
+    record = get_digest_record(digest_id)
+    if not record or record["owner_id"] != query.from_user.id:
+        await query.answer("__This digest has expired. Pending requests are still valid until they time out.__", show_alert=True)
+        return
 
-            # schedule deletion
-            run_time = datetime.now(IST) + (timedelta(minutes=delay_amount) if delay_unit == "Minutes" else timedelta(hours=delay_amount))
+    if action in ("pick", "back", "t"):
+        if action == "t":
             try:
-                scheduler.add_job(delete_message_job, "date", run_date=run_time, args=[sent_msg.chat.id, [sent_msg.id]], misfire_grace_time=300)
-            except Exception as e:
-                logging.warning("Failed to schedule delete job for message %s: %s", getattr(sent_msg, "id", None), e)
+                payment_id = record["items"][int(parts[3])]["payment_id"]
+            except (IndexError, ValueError):
+                await query.answer()
+                return
+            record["selected"] ^= {payment_id}
+        text, keyboard = render_digest(digest_id, selecting=action != "back")
+        try:
+            await query.message.edit_text(text, reply_markup=keyboard)
+        except MessageNotModified:
+            pass
+        await query.answer()
+        return
 
+    if action == "all":
+        payment_ids = [item["payment_id"] for item in record["items"]]
+    else:
+        payment_ids = [item["payment_id"] for item in record["items"] if item["payment_id"] in record["selected"]]
+    if not payment_ids:
+        await query.answer("Select at least one payment.", show_alert=True)
+        return
+    await query.answer("⏳ Processing...")
+    results = await _run_digest_action(payment_ids, approve=action != "no")
+
+    record["items"] = [item for item in record["items"] if item["payment_id"] not in payment_ids]
+    record["selected"].clear()
+    record["deliveries"] = []
+    text, keyboard = render_digest(digest_id)
+    summary = ", ".join(f"{name} `{count}`" for name, count in results.items())
+    text += f"\n\n__✔️ Done: {summary}. Delivery confirmations follow in your next digest.__"
+    save_digest_record(digest_id)
+    try:
+        await query.message.edit_text(text, reply_markup=keyboard)
+    except MessageNotModified:
+        pass
+
+@app.on_message(filters.command("digest") & filters.private)
+async def digest_command(client: Client, message: Message):
+    user_id = message.from_user.id
+    arg = message.command[1].lower() if len(message.command) > 1 else ""
+    if arg not in ("on", "off"):
+        state = "ON" if is_digest_owner(user_id) else "OFF"
+        await message.reply(f"__📬 Payment digest is **{state}**.\nUse `/digest on` or `/digest off`.__")
+        return
+    enabled = arg == "on"
+    users_collection.update_one({"_id": user_id}, {"$set": {"digest_mode": enabled}}, upsert=True)
+    _digest_owner_cache[user_id] = (enabled, time.monotonic() + 60)
+    if enabled:
+        await message.reply(f"__✅ Digest ON. Payment requests and delivery confirmations will be grouped every {DIGEST_WINDOW_SECONDS}s.__")
+    else:
+        await message.reply("__✅ Digest OFF. You will get one message per payment again.__")
+
+# -------------------------
+# Streaming admin export (CSV / JSONL, gzip)
+# -------------------------
+# Rows are pulled through a batched cursor with a projection and written straight
+# into a gzip temp file, so memory stays flat however big the collection is.
+EXPORT_BATCH_SIZE = 1000
+# Telegram bots can upload at most 50 MB per file, so bigger exports are split into parts
+EXPORT_PART_BYTES = int(os.environ.get("EXPORT_PART_MB", 45)) * 1024 * 1024
+
+def _batch_export_row(doc: dict) -> dict:
+    return {
+        "batch_id": doc["_id"], "owner_id": doc.get("owner_id"), "is_paid": bool(doc.get("is_paid")),
+        "price": doc.get("price"), "file_count": get_batch_file_count(doc), "sales_count": doc.get("sales_count", 0),
+        "upi_id": doc.get("upi_id"), "created_at": doc.get("created_at"),
+    }
+
+EXPORT_SPECS = {
+    "batches": {
+        "collection": "file_batches", "date_field": "created_at",
+        "projection": {"owner_id": 1, "is_paid": 1, "price": 1, "message_ranges": 1, "message_ids": 1, "sales_count": 1, "upi_id": 1, "created_at": 1},
+        "row": _batch_export_row,
+    },
+    "users": {
+        "collection": "users", "date_field": "joined_date",
+        "projection": {"first_name": 1, "last_name": 1, "username": 1, "banned": 1, "unreachable": 1, "joined_date": 1},
+        "row": lambda doc: {"user_id": doc["_id"], "first_name": doc.get("first_name"), "last_name": doc.get("last_name"),
+                            "username": doc.get("username"), "banned": bool(doc.get("banned")),
+                            "unreachable": bool(doc.get("unreachable")), "joined_date": doc.get("joined_date")},
+    },
+    "payments": {
+        "collection": "pending_payments", "date_field": "created_at",
+        "projection": {"batch_id": 1, "buyer_id": 1, "unique_amount": 1, "created_at": 1},
+        "row": lambda doc: {"payment_id": doc["_id"], "batch_id": doc.get("batch_id"), "buyer_id": doc.get("buyer_id"),
+                            "unique_amount": doc.get("unique_amount"), "created_at": doc.get("created_at")},
+    },
+}
+
+def build_export_query(kind: str, args: list) -> dict:
+    """Parse `from=YYYY-MM-DD to=YYYY-MM-DD owner=<id> paid|free` into a Mongo filter (ValueError on bad input)."""
+    spec = EXPORT_SPECS[kind]
+    query, date_range = {}, {}
+    for arg in args:
+        key, _, value = arg.partition("=")
+        key = key.lower()
+        if key in ("from", "to") and value:
+            day = IST.localize(datetime.strptime(value, "%Y-%m-%d"))
+            if key == "from":
+                date_range["$gte"] = day
+            else:
+                date_range["$lt"] = day + timedelta(days=1)
+        elif key == "owner" and kind == "batches":
+            query["owner_id"] = int(value)
+        elif key in ("paid", "free") and kind == "batches":
+            query["is_paid"] = key == "paid"
+        elif key not in ("csv", "jsonl"):
+            raise ValueError(f"unsupported filter `{arg}` for {kind}")
+    if date_range:
+        query[spec["date_field"]] = date_range
+    return query
+
+def export_collection(kind: str, fmt: str, query: dict) -> list:
+    """
+    Blocking: stream matching docs into gzip CSV/JSONL temp files, starting a new part whenever
+    one reaches EXPORT_PART_BYTES compressed. Each part is a complete file (CSV parts repeat the
+    header). Returns [(path, row_count)] per part.
+    """
+    spec = EXPORT_SPECS[kind]
+    collection = analytics_collection(spec["collection"])
+    parts = []
+    raw = fh = writer = None
+
+    def _close_part():
+        if fh is not None:
+            fh.close()  # closes the GzipFile and its file too
+
+    try:
+        for doc in collection.find(query, spec["projection"], batch_size=EXPORT_BATCH_SIZE).sort("_id", 1):
+            # compressed bytes written so far; zlib only holds back a small buffer beyond this
+            if fh is None or raw.fileobj.tell() >= EXPORT_PART_BYTES:
+                _close_part()
+                fd, path = tempfile.mkstemp(prefix=f"export-{kind}-", suffix=f".{fmt}.gz")
+                os.close(fd)
+                parts.append([path, 0])
+                raw = gzip.GzipFile(path, "wb")
+                fh = TextIOWrapper(raw, encoding="utf-8", newline="", write_through=True)
+                writer = None
+            row = spec["row"](doc)
+            if fmt == "csv":
+                if writer is None:
+                    writer = csv.DictWriter(fh, fieldnames=list(row.keys()))
+                    writer.writeheader()
+                writer.writerow({k: v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()})
+            else:
+                fh.write(json.dumps(row, default=str) + "\n")
+            parts[-1][1] += 1
+    except BaseException:
+        _close_part()
+        for path, _ in parts:
+            os.remove(path)
+        raise
+    _close_part()
+    return [tuple(part) for part in parts]
+
+@app.on_message(filters.command("export") & filters.private & filters.user(ADMINS))
+async def export_handler(client: Client, message: Message):
+    args = message.command[1:]
+    if not args or args[0].lower() not in EXPORT_SPECS:
+        await message.reply("__Usage: `/export <batches|users|payments> [csv|jsonl] [from=YYYY-MM-DD] [to=YYYY-MM-DD] [owner=<id>] [paid|free]`__")
+        return
+    kind = args[0].lower()
+    fmt = "jsonl" if "jsonl" in (a.lower() for a in args[1:]) else "csv"
+    try:
+        query = build_export_query(kind, args[1:])
+    except ValueError as e:
+        await message.reply(f"__❌ Invalid filter: {e}__")
+        return
+    status_msg = await message.reply(f"__⏳ Exporting {kind}...__")
+    parts = []
+    try:
+        parts = await asyncio.to_thread(export_collection, kind, fmt, query)
+        stamp = datetime.now(IST).strftime("%Y%m%d-%H%M%S")
+        if not parts:
+            await status_msg.edit_text(f"__📦 **{kind}** export: no matching rows.__")
+            return
+        for number, (path, rows) in enumerate(parts, 1):
+            suffix = f"-part{number}of{len(parts)}" if len(parts) > 1 else ""
+            await client.send_document(message.chat.id, path, file_name=f"{kind}-{stamp}{suffix}.{fmt}.gz",
+                                       caption=f"__📦 **{kind}** export{suffix.replace('-', ' ')}: `{rows}` rows.__")
+        await status_msg.delete()
+    except Exception as e:
+        logging.exception("Export of %s failed: %s", kind, e)
+        await status_msg.edit_text(f"__❌ Export failed: `{e}`__")
+    finally:
+        for path, _ in parts:
+            if os.path.exists(path):
+                os.remove(path)
+
+# -------------------------
+# Broadcast engine (streamed, rate limited, checkpointed)
+# -------------------------
+# Users are read in _id order, BROADCAST_CHUNK_SIZE at a time (keyset, no long-lived
+# cursor). Each chunk is sent by BROADCAST_CONCURRENCY workers sharing one pacing
+# clock, then the last _id of the chunk is checkpointed in settings, so a restart
+# resumes from there and re-sends at most one partial chunk.
+BROADCAST_STATE_ID = "broadcast"
+broadcast_runtime = {"task": None, "cancel": False}
+
+class _RatePacer:
+    """Hands out send slots at most `rate` per second to any number of workers."""
+    def __init__(self, rate: float):
+        self.interval = 1.0 / max(rate, 0.1)
+        self.next_slot = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        self.next_slot = max(self.next_slot, time.monotonic() + seconds)
+
+async def _broadcast_send(user_id: int, state: dict, pacer: _RatePacer, counters: Counter):
+    for _ in range(3):
+        await pacer.wait()
+        try:
+            await app.copy_message(chat_id=user_id, from_chat_id=state["source_chat"], message_id=state["source_msg_id"])
+            counters["sent"] += 1
+            return
+        except FloodWait as e:
+            # FloodWait is per bot, so every worker backs off
+            pacer.pause(e.value + 1)
         except (UserIsBlocked, InputUserDeactivated):
-            all_sent_successfully = False
-            logging.warning("Failed to send file to %s: blocked/deactivated", user_id)
+            counters["blocked"] += 1
+            users_collection.update_one({"_id": user_id}, {"$set": {"unreachable": True}})
+            return
+        except Exception as e:
+            logging.debug("Broadcast to %s failed: %s", user_id, e)
             break
+    counters["failed"] += 1
+
+def _broadcast_status_text(state: dict) -> str:
+    elapsed = max(1, (datetime.now(timezone.utc) - state["started_at"].replace(tzinfo=timezone.utc)).total_seconds())
+    done = state["sent"] + state["blocked"] + state["failed"]
+    return (
+        f"__📣 **Broadcast {state['status'].upper()}**\n\n- Processed: `{done}` / ~`{state['total']}`\n- Sent: `{state['sent']}`\n"
+        f"- Blocked/Deactivated: `{state['blocked']}`\n- Failed: `{state['failed']}`\n- Rate: `{done / elapsed:.1f}/s`__"
+    )
+
+async def _update_broadcast_status(state: dict):
+    try:
+        await app.edit_message_text(state["status_chat"], state["status_msg_id"], _broadcast_status_text(state))
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logging.debug("Could not update broadcast status: %s", e)
+
+async def run_broadcast():
+    """Run (or resume) the broadcast described by the settings checkpoint."""
+    state = settings_collection.find_one({"_id": BROADCAST_STATE_ID})
+    if not state or state.get("status") != "running":
+        return
+    pacer = _RatePacer(BROADCAST_RATE)
+    last_status_edit = 0.0
+    query_base = {"banned": {"$ne": True}, "unreachable": {"$ne": True}}
+    while not broadcast_runtime["cancel"]:
+        query = dict(query_base)
+        if state.get("last_id") is not None:
+            query["_id"] = {"$gt": state["last_id"]}
+        user_ids = [doc["_id"] for doc in users_collection.find(query, {"_id": 1}).sort("_id", 1).limit(BROADCAST_CHUNK_SIZE)]
+        if not user_ids:
+            break
+
+        counters = Counter()
+        queue = asyncio.Queue()
+        for user_id in user_ids:
+            queue.put_nowait(user_id)
+
+        async def _worker():
+            while not queue.empty() and not broadcast_runtime["cancel"]:
+                await _broadcast_send(queue.get_nowait(), state, pacer, counters)
+
+        await asyncio.gather(*(_worker() for _ in range(min(BROADCAST_CONCURRENCY, len(user_ids)))))
+        if broadcast_runtime["cancel"] and not queue.empty():
+            break  # keep the checkpoint before this chunk; it is re-sent on resume
+
+        state["last_id"] = user_ids[-1]
+        for key in ("sent", "blocked", "failed"):
+            state[key] += counters[key]
+        settings_collection.update_one({"_id": BROADCAST_STATE_ID}, {"$set": {
+            "last_id": state["last_id"], "sent": state["sent"], "blocked": state["blocked"], "failed": state["failed"]}})
+        if time.monotonic() - last_status_edit > 3:
+            last_status_edit = time.monotonic()
+            await _update_broadcast_status(state)
+
+    state["status"] = "cancelled" if broadcast_runtime["cancel"] else "finished"
+    settings_collection.update_one({"_id": BROADCAST_STATE_ID}, {"$set": {"status": state["status"]}})
+    await _update_broadcast_status(state)
+    logging.info("Broadcast %s: sent=%s blocked=%s failed=%s", state["status"], state["sent"], state["blocked"], state["failed"])
+
+def start_broadcast_task():
+    broadcast_runtime["cancel"] = False
+    task = asyncio.get_running_loop().create_task(run_broadcast())
+    broadcast_runtime["task"] = task
+
+    def _done(t: asyncio.Task):
+        if not t.cancelled() and t.exception():
+            logging.error("Broadcast task crashed: %s", t.exception())
+    task.add_done_callback(_done)
+
+def broadcast_is_running() -> bool:
+    task = broadcast_runtime.get("task")
+    return task is not None and not task.done()
+
+@app.on_message(filters.command("broadcast") & filters.private & filters.user(ADMINS))
+async def broadcast_handler(client: Client, message: Message):
+    arg = message.command[1].lower() if len(message.command) > 1 else ""
+    if arg == "cancel":
+        if not broadcast_is_running():
+            await message.reply("__No broadcast is running.__")
+            return
+        broadcast_runtime["cancel"] = True
+        await message.reply("__🛑 Cancelling broadcast after the current sends...__")
+        return
+    if arg == "status":
+        state = settings_collection.find_one({"_id": BROADCAST_STATE_ID})
+        await message.reply(_broadcast_status_text(state) if state else "__No broadcast has been run yet.__")
+        return
+    if broadcast_is_running():
+        await message.reply("__❗️ A broadcast is already running. Use `/broadcast status` or `/broadcast cancel`.__")
+        return
+    if not message.reply_to_message:
+        await message.reply("__Usage: reply to the message to send with `/broadcast`.\nAlso: `/broadcast status`, `/broadcast cancel`.__")
+        return
+
+    total = users_collection.count_documents({"banned": {"$ne": True}, "unreachable": {"$ne": True}})
+    status_msg = await message.reply("__📣 Broadcast starting...__")
+    state = {
+        "_id": BROADCAST_STATE_ID,
+        "status": "running",
+        "source_chat": message.chat.id,
+        "source_msg_id": message.reply_to_message.id,
+        "status_chat": message.chat.id,
+        "status_msg_id": status_msg.id,
+        "last_id": None,
+        "total": total,
+        "sent": 0, "blocked": 0, "failed": 0,
+        "started_at": datetime.now(timezone.utc),
+    }
+    settings_collection.replace_one({"_id": BROADCAST_STATE_ID}, state, upsert=True)
+    start_broadcast_task()
+
+async def resume_broadcast_if_pending():
+    state = settings_collection.find_one({"_id": BROADCAST_STATE_ID}, {"status": 1})
+    if state and state.get("status") == "running":
+        logging.info("Resuming interrupted broadcast from checkpoint.")
+        start_broadcast_task()
+
+# -------------------------
+# Graceful drain & handoff of in-flight work
+# -------------------------
+# On SIGTERM: refuse new updates, pause the scheduler, give in-flight deliveries and loop
+# work DRAIN_TIMEOUT_SECONDS to complete, stop the scheduler (letting running jobs finish),
+# then save whatever is still unfinished into `handoff`, tagged with PROCESS_ID. Other processes
+# claim it in restore_handoff(), on start and then every HANDOFF_POLL_SECONDS.
+def _json_state(value):
+    """Tuples (file refs) become lists in BSON; sets/Tasks/Messages are not persisted."""
+    if isinstance(value, dict):
+        return {str(k): _json_state(v) for k, v in value.items() if not isinstance(v, (asyncio.Task, Message))}
+    if isinstance(value, (list, tuple)):
+        return [_json_state(v) for v in value]
+    return value
+
+def _ref_list(value) -> list:
+    return [tuple(ref) for ref in value or []]
+
+def _save_handoff(docs: list):
+    # never clear the collection: it may hold another draining process's unclaimed handoff
+    for doc in docs:
+        doc["process_id"] = PROCESS_ID
+    if docs:
+        handoff_collection.insert_many(docs)
+
+def _claim_handoff() -> list:
+    """Atomically take every handoff doc written by other processes (so two new processes never share one)."""
+    docs = []
+    while True:
+        doc = handoff_collection.find_one_and_delete({"process_id": {"$ne": PROCESS_ID}})
+        if doc is None:
+            return docs
+        docs.append(doc)
+
+async def drain(timeout: float = DRAIN_TIMEOUT_SECONDS):
+    runtime_state["draining"] = True
+    deadline = time.monotonic() + timeout
+    logging.info("Draining: waiting up to %ss for in-flight work.", timeout)
+
+    # paused, no new jobs fire, but deliveries finishing below can still add their
+    # delete jobs to the Mongo job store (a stopped scheduler would only keep them in memory)
+    try:
+        if scheduler.running:
+            scheduler.pause()
+    except Exception as e:
+        logging.warning("Error pausing scheduler during drain: %s", e)
+
+    pending = set(inflight_deliveries) | {asyncio.wrap_future(f) for f in list(inflight_futures)}
+    pending |= {sess["job"] for sess in user_sessions.values() if sess.get("job") and not sess["job"].done()}
+    if pending:
+        _, pending = await asyncio.wait(pending, timeout=max(0.0, deadline - time.monotonic()))
+
+    docs = []
+    for task, progress in list(inflight_deliveries.items()):
+        docs.append({"kind": "delivery", "data": dict(progress)})
+        task.cancel()  # the next process resumes it from next_index
+
+    # approvals and delivery confirmations still waiting for their digest window
+    try:
+        await flush_all_owner_digests()
+    except Exception as e:
+        logging.warning("Error flushing payment digests during drain: %s", e)
+
+    # running jobs finish; not-yet-due jobs stay in the Mongo job store for the next process
+    try:
+        if scheduler.running:
+            await asyncio.to_thread(scheduler.shutdown, True)
+    except Exception as e:
+        logging.warning("Error shutting down scheduler during drain: %s", e)
+    for user_id, sess in user_sessions.items():
+        if sess.get("files"):
+            docs.append({"kind": "session", "user_id": user_id, "data": {
+                "files": [list(f) for f in sess["files"]], "albums": sorted(sess["albums"]),
+                "menu_msg_id": sess.get("menu_msg_id"), "last_msg_id": sess.get("last_msg_id")}})
+    for user_id, state in user_states.items():
+        docs.append({"kind": "state", "user_id": user_id, "data": _json_state(state)})
+    for batch_id, session in EDIT_SESSIONS.items():
+        docs.append({"kind": "edit", "batch_id": batch_id, "data": _json_state(session)})
+    for user_id, waiter in join_waiters.items():
+        elapsed_checks = int((time.time() - waiter["started"]) // 5)
+        docs.append({"kind": "join", "user_id": user_id, "data": {"batch_id": waiter["batch_id"], "checks": max(1, waiter["checks"] - elapsed_checks)}})
+        waiter["task"].cancel()
+    try:
+        await asyncio.to_thread(_save_handoff, docs)
+        logging.info("Drain complete: %d unfinished item(s) handed off (%d task(s) still running at deadline).", len(docs), len(pending))
+    except Exception as e:
+        logging.exception("Failed to save handoff state: %s", e)
+
+async def restore_handoff():
+    docs = await asyncio.to_thread(_claim_handoff)
+    if not docs:
+        return
+    logging.info("Restoring %d handed-off item(s) from previous process.", len(docs))
+    for doc in docs:
+        kind, data = doc["kind"], doc["data"]
+        try:
+            if kind == "delivery":
+                batch_record = files_collection.find_one({"_id": data["batch_id"]}, BATCH_READ_PROJECTION)
+                if batch_record:
+                    asyncio.create_task(send_files_from_batch(app, data["user_id"], batch_record, data["delay_amount"], data["delay_unit"], start_index=data["next_index"]))
+            elif kind == "session":
+                sess = new_upload_session()
+                sess["files"] = [tuple(f) for f in data.get("files", [])]
+                if sess["files"]:
+                    sess.update(albums=set(data.get("albums", [])), menu_msg_id=data.get("menu_msg_id"),
+                                last_msg_id=data.get("last_msg_id") or sess["files"][-1][0])
+                    user_sessions[doc["user_id"]] = sess
+                    await update_batch_menu(app, doc["user_id"])
+            elif kind == "state":
+                if "file_refs" in data:
+                    data["file_refs"] = _ref_list(data["file_refs"])
+                user_states[doc["user_id"]] = data
+            elif kind == "edit":
+                data["files"] = _ref_list(data.get("files"))
+                data["original_files"] = _ref_list(data.get("original_files"))
+                EDIT_SESSIONS[doc["batch_id"]] = data
+            elif kind == "join":
+                start_join_waiter(app, doc["user_id"], data["batch_id"], checks=data["checks"])
         except Exception as e:
-            all_sent_successfully = False
-            logging.exception("Error sending file %s to %s: %s", msg_id, user_id, e)
-            try:
-                await client.send_message(user_id, "__❌ Could Not Send One Of The Files. It Might Have Been Deleted From The Source.__")
-            except Exception:
-                pass
-    return all_sent_successfully
+            logging.warning("Could not restore handed-off %s item: %s", kind, e)
+
+async def handoff_poller():
+    """Keep claiming handoff docs after startup: in a rolling restart the old process drains after we are up."""
+    while not runtime_state["draining"]:
+        await asyncio.sleep(HANDOFF_POLL_SECONDS)
+        if runtime_state["draining"]:
+            return
+        try:
+            await restore_handoff()
+        except Exception as e:
+            logging.warning("Could not restore handed-off work: %s", e)
 
 # -------------------------
 # Startup & shutdown with asyncio-safe main()
 # -------------------------
+MONGO_INIT_RETRIES = int(os.environ.get("MONGO_INIT_RETRIES", 10))
+
+def init_mongo():
+    """Ping Mongo (retrying with backoff instead of dying on a hiccup), then indexes and settings."""
+    delay = 1.0
+    for attempt in range(1, MONGO_INIT_RETRIES + 1):
+        try:
+            get_mongo_client().admin.command("ping")
+            break
+        except Exception as e:
+            if attempt == MONGO_INIT_RETRIES:
+                raise
+            logging.warning("MongoDB not reachable (attempt %d/%d): %s", attempt, MONGO_INIT_RETRIES, e)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+    logging.info("Connected to MongoDB.")
+    # index builds can take a while on big collections; don't hold up readiness for them
+    Thread(target=ensure_indexes, daemon=True, name="index-builder").start()
+    try:
+        load_rate_limits()
+    except Exception as e:
+        logging.warning("Could not load rate limits, using defaults: %s", e)
+
+def init_scheduler():
+    scheduler.add_jobstore(MongoDBJobStore(database="file_link_bot", collection="scheduler_jobs", client=get_mongo_client()), "default")
+    scheduler.start()
+    logging.info("Scheduler started.")
+
 async def start_services():
-    """Start scheduler and Flask server (Flask runs in a background thread)."""
+    """
+    Bring up Mongo (then the scheduler, whose job store needs it), the HTTP server, the
+    Pyrogram client and the delivery pool concurrently, then resume handed-off work and
+    mark the bot ready. Returns False, without marking ready, if a required service failed.
+    """
+    started = time.perf_counter()
+    timings = {}
+    failed = {}
+
+    async def _timed(name: str, start):
+        t0 = time.perf_counter()
+        try:
+            await start()
+            return True
+        except Exception as e:
+            failed[name] = e
+            return False
+        finally:
+            timings[name] = time.perf_counter() - t0
+
+    async def _mongo_then_scheduler():
+        # a scheduler started without its Mongo job store would keep jobs only in memory
+        if await _timed("mongo", lambda: asyncio.to_thread(init_mongo)):
+            await _timed("scheduler", lambda: asyncio.to_thread(init_scheduler))
+        else:
+            failed["scheduler"] = RuntimeError("not started: MongoDB unavailable")
+
+    await asyncio.gather(
+        _mongo_then_scheduler(),
+        _timed("http", lambda: asyncio.to_thread(start_http_server)),
+        _timed("pyrogram", app.start),
+        _timed("delivery_pool", start_delivery_clients),  # optional: deliveries fall back to the main client
+    )
+    for name, err in failed.items():
+        logging.error("Service %s failed to start: %s", name, err)
+    if failed.keys() & {"mongo", "scheduler", "http", "pyrogram"}:
+        return False
+    logging.info("Pyrogram client started.")
+
+    # periodic analytics flush & event-loop lag monitor (must run inside the bot loop)
+    asyncio.get_running_loop().create_task(analytics_flusher())
+    start_loop_monitor()
+
+    try:
+        await restore_handoff()
+    except Exception as e:
+        logging.warning("Could not restore handed-off work: %s", e)
+    asyncio.get_running_loop().create_task(handoff_poller())
     try:
-        scheduler.start()
-        logging.info("Scheduler started.")
+        await resume_broadcast_if_pending()
     except Exception as e:
-        logging.exception("Failed to start scheduler: %s", e)
+        logging.warning("Could not resume broadcast: %s", e)
 
-    # start flask in thread (health checks)
-    flask_thread = Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logging.info("Flask webserver started.")
+    services_ready.set()
+    total = time.perf_counter() - started
+    breakdown = ", ".join(f"{name}={secs:.2f}s" for name, secs in timings.items())
+    # the sum of the per-service times is what the old one-after-another startup would have taken
+    logging.info("Ready in %.2fs (sequential equivalent %.2fs): %s", total, sum(timings.values()), breakdown)
+    return True
 
 async def stop_services():
     """Stop scheduler and any background tasks cleanly."""
+    await flush_analytics()
+    await stop_delivery_clients()
     try:
-        scheduler.shutdown(wait=False)
-        logging.info("Scheduler shutdown requested.")
+        if scheduler.running:
+            scheduler.shutdown(wait=False)
+            logging.info("Scheduler shutdown requested.")
     except Exception as e:
         logging.warning("Error shutting down scheduler: %s", e)
+    server = _resources.pop("http", None)
+    if server is not None:
+        await asyncio.to_thread(server.shutdown)
 
 async def shutdown(loop, stop_event: asyncio.Event):
     """Trigger shutdown when called from signal handler."""
@@ -1102,16 +3295,15 @@ async def main():
             # some platforms (Windows) may not support add_signal_handler
             pass
 
-    # start services
-    await start_services()
-
-    # start the pyrogram client
-    try:
-        await app.start()
-        logging.info("Pyrogram client started.")
-    except Exception as e:
-        logging.exception("Failed to start Pyrogram client: %s", e)
-        # try to stop scheduler/flask and exit
+    # start every service concurrently (Mongo, scheduler, HTTP, Pyrogram, delivery pool)
+    if not await start_services():
+        logging.error("Required services failed to start; exiting.")
+        # try to stop whatever did start and exit, so the orchestrator restarts us
+        if app.is_connected:
+            try:
+                await app.stop()
+            except Exception as e:
+                logging.warning("Error stopping Pyrogram client: %s", e)
         await stop_services()
         return
 
@@ -1122,7 +3314,12 @@ async def main():
     finally:
         logging.info("Stop signal received. Shutting down...")
 
-    # graceful shutdown
+    # graceful shutdown: finish or hand off in-flight work before disconnecting
+    try:
+        await drain()
+    except Exception as e:
+        logging.warning("Error during drain: %s", e)
+
     try:
         await app.stop()
         logging.info("Pyrogram client stopped.")